@@ -1,4 +1,35 @@
+import hashlib
+from collections import deque
+
+import numpy as np
+
+from results import CohortSolution
+
+
+class ActionSchema(object):
+    # Declarative deterministic action: if every fact of preconditions holds, the facts of
+    # delete_list are removed and those of add_list added. Otherwise on_failure decides:
+    # 'complete' ends the task (adds the terminal fact), 'stay' leaves the state unchanged.
+    def __init__(self, preconditions=(), add_list=(), delete_list=(), on_failure='complete'):
+        if on_failure not in ('complete', 'stay'):
+            raise ValueError("on_failure must be 'complete' or 'stay', got " + repr(on_failure))
+        self.preconditions = frozenset(preconditions)
+        self.add_list = frozenset(add_list)
+        self.delete_list = frozenset(delete_list)
+        self.on_failure = on_failure
+
+    def __repr__(self):
+        return 'ActionSchema(preconditions=%r, add_list=%r, delete_list=%r, on_failure=%r)' % (
+            sorted(self.preconditions), sorted(self.add_list), sorted(self.delete_list), self.on_failure)
+
+
 class MDP(object):
+    # fact that marks the absorbing end of an episode, states containing it give no reward
+    terminal_fact = 'task_complete'
+    # {action: ActionSchema} of declarative domains, compiled to bitmask operations on first use;
+    # None for domains that implement get_next_state / get_transition_probability themselves
+    action_schema = None
+
     def __init__(self): # constructor method initializes an instance of the 'MDP' class
         pass # placeholder indicating that no initialization actions are performed
 
@@ -9,23 +40,517 @@ class MDP(object):
         return self.actions # returns the of possible actions that can be taken in the MDP
 
     def get_transition_probability(self, state, action, next_state):
-        # intended to return the transition probability from one state to another given an action
-        return 0
+        # intended to return the transition probability from one state to another given an action;
+        # deterministic domains (see get_next_state) put all the probability on their successor
+        successor = self.get_next_state(state, action)
+        if successor is None:
+            return 0
+        return 1 if next_state == successor else 0
+
+    def get_next_state(self, state, action):
+        # intended to return the successor of a deterministic transition directly; domains with
+        # an action_schema get it from the compiled bitmask operations, domains that only
+        # implement get_transition_probability keep returning None
+        if self.action_schema is None:
+            return None
+        return self.get_state_from_bits(self.get_next_state_bits(self.get_state_bits(state), action))
+
+    def get_compiled_actions(self):
+        # action_schema compiled to {action: (precondition bits, add bits, delete bits, failure bits)},
+        # failure bits are what a failed action ORs into the state (terminal_fact or nothing)
+        if getattr(self, 'compiled_actions', None) is None:
+            fact_bits = self.get_fact_bits()
+            # checked once here, get_next_state_bits relies on it
+            if self.terminal_fact not in fact_bits:
+                raise ValueError("Terminal fact not in fact_list: " + str(self.terminal_fact))
+
+            def to_bits(facts):
+                bits = 0
+                for fact in facts:
+                    if fact not in fact_bits:
+                        raise ValueError("Unknown fact in action schema: " + str(fact))
+                    bits |= fact_bits[fact]
+                return bits
+            self.compiled_actions = {}
+            for action, schema in self.action_schema.items():
+                failure_bits = fact_bits[self.terminal_fact] if schema.on_failure == 'complete' else 0
+                self.compiled_actions[action] = (to_bits(schema.preconditions), to_bits(schema.add_list),
+                                                 to_bits(schema.delete_list), failure_bits)
+        return self.compiled_actions
+
+    def get_next_state_bits(self, bits, action):
+        # successor bitmask of an action_schema domain, terminal states are absorbing
+        compiled_actions = self.get_compiled_actions()
+        terminal_bit = self.get_fact_bits()[self.terminal_fact]
+        if bits & terminal_bit:
+            return bits
+        precondition_bits, add_bits, delete_bits, failure_bits = compiled_actions[action]
+        if bits & precondition_bits == precondition_bits:
+            return (bits & ~delete_bits) | add_bits
+        return bits | failure_bits
+
+    def get_successors(self, state, action):
+        # (next_state, probability) pairs with non-zero probability
+        next_state = self.get_next_state(state, action)
+        if next_state is not None:
+            return [(next_state, 1)]
+        successors = []
+        for s_prime in self.get_state_space():
+            p = self.get_transition_probability(state, action, s_prime)
+            if p > 0:
+                successors.append((s_prime, p))
+        return successors
 
     def get_init_state(self):
         return self.init_state # returns the initial state of the MDP
 
     def get_state_hash(self, state):
-        unique_state_sort = sorted(list(state))
-        return str(unique_state_sort) # returns a hashable representation (specifically a string) of a given state
+        return self.get_state_bits(state) # returns a hashable representation (the fact bitmask) of a given state
                           # this can be useful for storing states in data structures like dictionaries or sets
 
+    def get_fact_bits(self):
+        # every fact of fact_list is one bit of an integer: fact i <-> 1 << i
+        if getattr(self, 'fact_bits', None) is None:
+            self.fact_bits = {fact: 1 << i for i, fact in enumerate(self.fact_list)}
+        return self.fact_bits
+
+    def get_state_bits(self, state):
+        # human-readable fact set -> integer bitmask
+        if isinstance(state, int):
+            return state
+        fact_bits = self.get_fact_bits()
+        bits = 0
+        for fact in state:
+            bits |= fact_bits[fact]
+        return bits
+
+    def get_state_from_bits(self, bits):
+        # integer bitmask -> human-readable fact set
+        return set(fact for i, fact in enumerate(self.fact_list) if bits >> i & 1)
+
+    def generate_bitmask_state_space(self):
+        # every subset of fact_list, ordered so that the index of a state is its bitmask
+        return [self.get_state_from_bits(bits) for bits in range(1 << len(self.fact_list))]
+
     def get_goal_states(self):
         return [] # returns a list of goal states for the MDP
-    
+
+    def generate_reachable_state_space(self):
+        # breadth-first search from the initial state over all actions, so only states the
+        # agent can actually end up in (including the absorbing task_complete ones) are
+        # kept; needs init_state, actions and get_next_state to be available
+        init_state = self.get_init_state()
+        if self.action_schema is not None:
+            # the whole search runs on integer bitmasks
+            init_bits = self.get_state_bits(init_state)
+            visited = set([init_bits])
+            state_bits = [init_bits]
+            queue = deque(state_bits)
+            while queue:
+                bits = queue.popleft()
+                for a in self.get_actions():
+                    next_bits = self.get_next_state_bits(bits, a)
+                    if next_bits not in visited:
+                        visited.add(next_bits)
+                        state_bits.append(next_bits)
+                        queue.append(next_bits)
+            return [init_state] + [self.get_state_from_bits(bits) for bits in state_bits[1:]]
+        state_space = [init_state]
+        visited = set([self.get_state_hash(init_state)])
+        queue = deque([init_state])
+        while queue:
+            state = queue.popleft()
+            for a in self.get_actions():
+                for s_prime, _ in self.get_successors(state, a):
+                    s_prime_hash = self.get_state_hash(s_prime)
+                    if s_prime_hash not in visited:
+                        visited.add(s_prime_hash)
+                        state_space.append(s_prime)
+                        queue.append(s_prime)
+        return state_space
+
+    def get_fact_indicator_matrix(self):
+        # (states x facts) 0/1 matrix, entry [s, f] is 1 if fact_list[f] holds in state s
+        if getattr(self, 'fact_indicator_matrix', None) is None:
+            state_bits = np.array([self.get_state_bits(s) for s in self.get_state_space()], dtype=np.int64)
+            fact_bits = np.left_shift(1, np.arange(len(self.fact_list), dtype=np.int64))
+            self.fact_indicator_matrix = ((state_bits[:, None] & fact_bits) != 0).astype(np.float64)
+        return self.fact_indicator_matrix
+
+    def set_reward_weights(self, all_rewards):
+        # all_rewards holds one survey row per participant, laid out fact by fact and, within
+        # a fact, action by action (terminal_fact has no columns). Stored as the dense
+        # (participants x actions x facts) array reward_weights, plus the equivalent
+        # all_reward_matrices[participant_id][action][fact] dicts.
+        actions = self.get_actions()
+        self.reward_weights = self.get_reward_weights(all_rewards)
+        self.all_reward_matrices = [
+            {act: dict(zip(self.fact_list, weights[a_idx])) for a_idx, act in enumerate(actions)}
+            for weights in self.reward_weights.tolist()]
+        self.reward_tensor = None
+
+    def get_reward_weights(self, all_rewards):
+        # survey rows (see set_reward_weights) -> dense (participants x actions x facts) weights
+        all_rewards = np.asarray(all_rewards)
+        actions = self.get_actions()
+        reward_facts = [f_idx for f_idx, fact in enumerate(self.fact_list) if fact != self.terminal_fact]
+        reward_weights = np.zeros((all_rewards.shape[0], len(actions), len(self.fact_list)), dtype=all_rewards.dtype)
+        reward_weights[:, :, reward_facts] = \
+            all_rewards.reshape(all_rewards.shape[0], len(reward_facts), len(actions)).transpose(0, 2, 1)
+        return reward_weights
+
+    def set_participant_reward_weights(self, participant_id, reward_weights):
+        # replaces one participant's (actions x facts) weights, keeping the dicts and the cached
+        # reward tensor in step
+        reward_weights = np.asarray(reward_weights)
+        dtype = np.result_type(self.reward_weights, reward_weights)
+        if dtype != self.reward_weights.dtype:
+            self.reward_weights = self.reward_weights.astype(dtype)
+        self.reward_weights[participant_id] = reward_weights
+        self.all_reward_matrices[participant_id] = {
+            act: dict(zip(self.fact_list, weights)) for act, weights in
+            zip(self.get_actions(), self.reward_weights[participant_id].tolist())}
+        if getattr(self, 'reward_tensor', None) is not None:
+            self.reward_tensor[participant_id] = self.compute_reward_tensor(self.reward_weights[[participant_id]])[0]
+
+    def get_reward(self, state, action, participant_id=0):
+        if self.terminal_fact in state:
+            return 0
+        weights = self.reward_weights[participant_id, self.get_actions().index(action)]
+        return sum(weights[self.fact_list.index(fact)] for fact in state)
+
+    def get_reward_tensor(self, participant_ids=None):
+        # (participants x states x actions) array of R(s, a): the product of the state-fact
+        # indicator matrix with every participant's (actions x facts) weights, zeroed in the
+        # terminal states. The full cohort tensor is computed once and kept.
+        if participant_ids is None:
+            if getattr(self, 'reward_tensor', None) is None:
+                self.reward_tensor = self.compute_reward_tensor(self.reward_weights)
+            return self.reward_tensor
+        return self.compute_reward_tensor(self.reward_weights[list(participant_ids)])
+
+    def compute_reward_tensor(self, reward_weights):
+        indicator = self.get_fact_indicator_matrix()
+        non_terminal = 1 - indicator[:, self.fact_list.index(self.terminal_fact)]
+        return np.einsum('sf,paf->psa', indicator, reward_weights) * non_terminal[None, :, None]
+
+    def compile_transition_model(self):
+        # evaluates get_successors once for every (s, a) pair and keeps the result,
+        # so the solvers never have to call get_transition_probability again
+        self.transition_model = TransitionModel.from_mdp(self)
+        self.compiled_model = None
+        return self.transition_model
+
+    def get_compiled_model(self):
+        # read-only CompiledMDP snapshot of the domain, built once per compiled transition model
+        if getattr(self, 'compiled_model', None) is None:
+            self.compiled_model = CompiledMDP(self)
+        return self.compiled_model
+
+    def get_domain_fingerprint(self):
+        # content hash of the domain definition: class, facts, actions and compiled transitions
+        sha = hashlib.sha256()
+        sha.update(repr((type(self).__name__, list(self.fact_list), list(self.get_actions()))).encode())
+        sha.update(self.transition_model.get_fingerprint().encode())
+        return sha.hexdigest()
+
+    def init_solution_store(self, capacity=16, dtype=np.float64, mmap_dir=None):
+        # V, Q and Policy of every solved participant live in one array-backed CohortSolution;
+        # self.V / self.Q / self.Policy are its list-like views
+        state_hashes = [self.get_state_hash(s) for s in self.get_state_space()]
+        self.solutions = CohortSolution(state_hashes, self.get_actions(), capacity=capacity,
+                                        dtype=dtype, mmap_dir=mmap_dir)
+        self.V = self.solutions.V
+        self.Q = self.solutions.Q
+        self.Policy = self.solutions.Policy
+        # stored row -> (states x actions) mask of the actions value_iteration eliminated
+        self.eliminated_actions = {}
+        return self.solutions
+
+    def get_state_index(self, state):
+        # position of the state in get_state_space(), looked up through the compiled model
+        return self.transition_model.state_index[self.get_state_hash(state)]
+
+    def get_next_state_from_model(self, state, action):
+        # first successor of (state, action) in the compiled model, or the state itself if there is none
+        model = self.transition_model
+        next_idx = model.get_next_state_index(self.get_state_index(state), model.action_index[action])
+        if next_idx is None:
+            return state
+        return self.get_state_space()[next_idx]
+
 
 # This class provides a skeleton for representing an MDP 
 # but lacks implementation details for some methods. 
 # To make this class functional, you would need to define 
 # attributes such as state_space, actions, and init_state, 
-# and implement logic for methods like get_transition_probability.
\ No newline at end of file
+# and implement logic for methods like get_transition_probability.
+
+
+class CompiledMDP(object):
+    # Immutable snapshot of everything the solvers read from a domain: states, actions,
+    # the compiled transitions, the state-fact indicator matrix the rewards are built from,
+    # the discount and the initial state. Arrays are read-only and the lazily built tables of
+    # the transition model are filled up front, so one instance can be shared by any number
+    # of threads solving participants at the same time. Solves on it (Utils.solve,
+    # Utils.solve_cohort) return SolveResult objects instead of writing to the domain.
+    def __init__(self, mdp):
+        self.domain_name = type(mdp).__name__
+        self.discount = mdp.discount
+        self.fact_list = tuple(mdp.fact_list)
+        self.fact_bits = dict(mdp.get_fact_bits())
+        self.terminal_fact = mdp.terminal_fact
+        self.actions = tuple(mdp.get_actions())
+        self.states = tuple(frozenset(s) for s in mdp.get_state_space())
+        self.state_hashes = tuple(mdp.get_state_hash(s) for s in mdp.get_state_space())
+        self.transition_model = mdp.transition_model.freeze()
+        self.state_index = self.transition_model.state_index
+        self.n_states = len(self.states)
+        self.n_actions = len(self.actions)
+        self.init_index = mdp.get_state_index(mdp.get_init_state())
+        self.fact_indicator_matrix = mdp.get_fact_indicator_matrix().copy()
+        self.fact_indicator_matrix.flags.writeable = False
+        self.fingerprint = mdp.get_domain_fingerprint()
+
+    def get_state_space(self):
+        return self.states
+
+    def get_actions(self):
+        return self.actions
+
+    def get_init_state(self):
+        return self.states[self.init_index]
+
+    def get_state_hash(self, state):
+        return self.state_hashes[self.get_state_index(state)]
+
+    def get_state_index(self, state):
+        return self.state_index[MDP.get_state_bits(self, state)]
+
+    def get_fact_bits(self):
+        return self.fact_bits
+
+    def get_next_state_from_model(self, state, action):
+        next_idx = self.transition_model.get_next_state_index(self.get_state_index(state),
+                                                              self.transition_model.action_index[action])
+        if next_idx is None:
+            return state
+        return self.states[next_idx]
+
+    def get_domain_fingerprint(self):
+        return self.fingerprint
+
+    def get_reward_tensor(self, reward_weights):
+        # (participants x states x actions) R(s, a) from (participants x actions x facts) weights,
+        # see MDP.compute_reward_tensor
+        reward_weights = np.asarray(reward_weights)
+        non_terminal = 1 - self.fact_indicator_matrix[:, self.fact_list.index(self.terminal_fact)]
+        return np.einsum('sf,paf->psa', self.fact_indicator_matrix, reward_weights) * non_terminal[None, :, None]
+
+
+class TransitionModel(object):
+    # Sparse successor table of an MDP, compiled once when the domain is constructed.
+    # Successors are stored in CSR layout: the (state, action) pair with flat index
+    # k = s_idx * n_actions + a_idx owns indices[indptr[k]:indptr[k + 1]] (successor
+    # state indices) and probs[indptr[k]:indptr[k + 1]] (their probabilities).
+    def __init__(self, n_states, actions, indptr, indices, probs, state_index=None):
+        self.n_states = n_states
+        self.actions = list(actions)
+        self.n_actions = len(self.actions)
+        self.action_index = {a: a_idx for a_idx, a in enumerate(self.actions)}
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.probs = np.asarray(probs, dtype=np.float64)
+        self.state_index = state_index if state_index is not None else {}
+        self._successor_lists = None
+        self._predecessor_lists = None
+        self._absorbing_states = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_mdp(cls, mdp):
+        states = mdp.get_state_space()
+        actions = mdp.get_actions()
+        state_index = {mdp.get_state_hash(s): s_idx for s_idx, s in enumerate(states)}
+        indptr = [0]
+        indices = []
+        probs = []
+        if mdp.action_schema is not None:
+            # one deterministic successor per pair, straight from the bitmask operations
+            for s in states:
+                bits = mdp.get_state_bits(s)
+                for a in actions:
+                    indices.append(state_index[mdp.get_next_state_bits(bits, a)])
+                    probs.append(1)
+                    indptr.append(len(indices))
+            return cls(len(states), actions, indptr, indices, probs, state_index)
+        for s in states:
+            for a in actions:
+                for s_prime, p in mdp.get_successors(s, a):
+                    indices.append(state_index[mdp.get_state_hash(s_prime)])
+                    probs.append(p)
+                indptr.append(len(indices))
+        return cls(len(states), actions, indptr, indices, probs, state_index)
+
+    def get_fingerprint(self):
+        # content hash of the compiled table, two models with the same fingerprint have the
+        # same states, actions and transitions
+        if self._fingerprint is None:
+            sha = hashlib.sha256()
+            sha.update(repr((self.n_states, self.actions)).encode())
+            for array in (self.indptr, self.indices, self.probs):
+                sha.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = sha.hexdigest()
+        return self._fingerprint
+
+    def get_successors(self, s_idx, a_idx):
+        # (successor indices, probabilities) of a single (state, action) pair
+        k = s_idx * self.n_actions + a_idx
+        start, end = self.indptr[k], self.indptr[k + 1]
+        return self.indices[start:end], self.probs[start:end]
+
+    def get_next_state_index(self, s_idx, a_idx):
+        k = s_idx * self.n_actions + a_idx
+        if self.indptr[k] == self.indptr[k + 1]:
+            return None
+        return int(self.indices[self.indptr[k]])
+
+    def get_expected_values(self, V):
+        # sum_s' P(s' | s, a) * V[..., s'] for every (s, a) pair at once;
+        # V has shape (..., n_states) and the result has shape (..., n_states, n_actions)
+        V = np.asarray(V, dtype=np.float64)
+        weighted = V[..., self.indices] * self.probs
+        # a trailing zero column keeps every start offset in range for reduceat, also those of
+        # pairs without successors at the end of the table; such pairs are zeroed afterwards
+        weighted = np.concatenate([weighted, np.zeros(weighted.shape[:-1] + (1,))], axis=-1)
+        starts = self.indptr[:-1]
+        sums = np.add.reduceat(weighted, starts, axis=-1)
+        sums[..., starts == self.indptr[1:]] = 0
+        return sums.reshape(V.shape[:-1] + (self.n_states, self.n_actions))
+
+    def get_reverse_topological_order(self):
+        # state indices ordered so that successors come before their predecessors, which
+        # is the order backward induction solves them in. Actions that deterministically
+        # loop back to the same state (e.g. in absorbing states) are ignored; returns None
+        # if the remaining transition graph has a cycle.
+        return self._get_depth_first_postorder(allow_cycles=False)
+
+    def get_sweep_order(self):
+        # the same ordering for Gauss-Seidel sweeps, where cycles are allowed and the
+        # edges closing them are simply not followed
+        return self._get_depth_first_postorder(allow_cycles=True)
+
+    def _get_depth_first_postorder(self, allow_cycles):
+        successors = self.get_successor_lists()
+        next_indices = []
+        for s_idx in range(self.n_states):
+            s_next = set()
+            for indices, _ in successors[s_idx]:
+                if indices != [s_idx]:
+                    s_next.update(indices)
+            next_indices.append(sorted(s_next))
+        # 0 = unvisited, 1 = on the stack, 2 = finished
+        status = [0] * self.n_states
+        order = []
+        for root in range(self.n_states):
+            if status[root]:
+                continue
+            status[root] = 1
+            stack = [(root, iter(next_indices[root]))]
+            while stack:
+                s_idx, children = stack[-1]
+                for s_prime_idx in children:
+                    if status[s_prime_idx] == 1 and not allow_cycles:
+                        return None
+                    if status[s_prime_idx] == 0:
+                        status[s_prime_idx] = 1
+                        stack.append((s_prime_idx, iter(next_indices[s_prime_idx])))
+                        break
+                else:
+                    status[s_idx] = 2
+                    order.append(s_idx)
+                    stack.pop()
+        return order
+
+    def freeze(self):
+        # makes the arrays read-only and builds every cached table now, after which the model
+        # is never written to and can be shared between threads
+        for array in (self.indptr, self.indices, self.probs):
+            array.flags.writeable = False
+        self.get_successor_lists()
+        self.get_predecessor_lists()
+        self.get_absorbing_states()
+        self.get_fingerprint()
+        return self
+
+    def get_transition_counts(self):
+        # [s_idx] -> number of (action, successor) entries a full backup of s_idx reads
+        return np.diff(self.indptr[::self.n_actions])
+
+    def get_absorbing_states(self):
+        # [s_idx] -> True if every action keeps the state where it is (e.g. task_complete)
+        if self._absorbing_states is None:
+            successors = self.get_successor_lists()
+            self._absorbing_states = [all(indices == [s_idx] for indices, _ in successors[s_idx])
+                                      for s_idx in range(self.n_states)]
+        return self._absorbing_states
+
+    def get_predecessor_lists(self):
+        # [s_prime_idx] -> indices of the states with some action leading to s_prime_idx
+        if self._predecessor_lists is None:
+            predecessors = [set() for _ in range(self.n_states)]
+            for s_idx, s_successors in enumerate(self.get_successor_lists()):
+                for indices, _ in s_successors:
+                    for s_prime_idx in indices:
+                        predecessors[s_prime_idx].add(s_idx)
+            self._predecessor_lists = [sorted(preds) for preds in predecessors]
+        return self._predecessor_lists
+
+    def is_deterministic(self):
+        # every (state, action) pair has at most one successor, reached with probability 1
+        return bool((np.diff(self.indptr) <= 1).all() and (self.probs == 1).all())
+
+    def evaluate_policy(self, policy, rewards, discount):
+        # Exact values of a deterministic policy on a deterministic model: policy is [s_idx] -> a_idx
+        # and rewards the (states x actions) table. Following the policy from any state ends in a
+        # cycle (possibly a self-loop) or a pair without successors, so every value is a finite
+        # discounted sum: cycles are solved in closed form, the paths into them backwards.
+        policy = [int(a_idx) for a_idx in policy]
+        next_index = [self.get_next_state_index(s_idx, a_idx) for s_idx, a_idx in enumerate(policy)]
+        reward = [float(rewards[s_idx][a_idx]) for s_idx, a_idx in enumerate(policy)]
+        V = [None] * self.n_states
+        for start in range(self.n_states):
+            path = []
+            on_path = {}
+            s_idx = start
+            while s_idx is not None and V[s_idx] is None and s_idx not in on_path:
+                on_path[s_idx] = len(path)
+                path.append(s_idx)
+                s_idx = next_index[s_idx]
+            if s_idx is not None and V[s_idx] is None:
+                # the path closed a cycle at s_idx
+                cycle = path[on_path[s_idx]:]
+                path = path[:on_path[s_idx]]
+                value = sum(discount ** i * reward[c_idx] for i, c_idx in enumerate(cycle)) / \
+                    (1 - discount ** len(cycle))
+                V[cycle[0]] = value
+                for c_idx in reversed(cycle[1:]):
+                    value_next = V[next_index[c_idx]]
+                    V[c_idx] = reward[c_idx] + discount * value_next
+            for p_idx in reversed(path):
+                next_idx = next_index[p_idx]
+                V[p_idx] = reward[p_idx] + (discount * V[next_idx] if next_idx is not None else 0)
+        return np.array(V)
+
+    def get_successor_lists(self):
+        # the same table as nested python lists [s_idx][a_idx] -> (indices, probs),
+        # which is faster than indexing numpy arrays element by element in scalar loops
+        if self._successor_lists is None:
+            indptr = self.indptr.tolist()
+            indices = self.indices.tolist()
+            probs = self.probs.tolist()
+            self._successor_lists = [
+                [(indices[indptr[k]:indptr[k + 1]], probs[indptr[k]:indptr[k + 1]])
+                 for k in range(s_idx * self.n_actions, (s_idx + 1) * self.n_actions)]
+                for s_idx in range(self.n_states)]
+        return self._successor_lists
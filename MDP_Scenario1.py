@@ -1,5 +1,7 @@
-from MDP import MDP
+from MDP import MDP, TransitionModel
+import numpy as np
 import pandas as pd
+from Utils import get_stopping_rules, get_greedy_actions, batch_value_iteration_on_model, _make_backup
 
 class MDP_Scenario1(MDP):
     def __init__(self):
@@ -162,8 +164,8 @@ class MDP_Scenario1(MDP):
         df_slice = df.iloc[1, 89:119] # note: currently still read the first response only
         # print(df_slice)
         reward_list = df_slice.tolist()
-        n_facts = len(mdp.get_init_state())
-        n_actions = len(mdp.get_actions())
+        n_facts = len(self.get_init_state())
+        n_actions = len(self.get_actions())
         rewards_matrix = [[0 for _ in range(n_actions)] for _ in range(n_facts)]
         idx = 0
         for i in range(n_facts):
@@ -182,8 +184,8 @@ class MDP_Scenario1(MDP):
             if (pd.isna(df.iloc[id, 89]) == False): # check whether it is USAR robot case
                 # print(i, df.iloc[id, 89:119].tolist())
                 reward_list = df.iloc[id, 89:119].tolist()
-                n_facts = len(mdp.get_init_state())
-                n_actions = len(mdp.get_actions())
+                n_facts = len(self.get_init_state())
+                n_actions = len(self.get_actions())
                 rewards_matrix = [[0 for _ in range(n_actions)] for _ in range(n_facts)]
                 idx = 0
                 for i in range(n_facts):
@@ -203,7 +205,7 @@ class MDP_Scenario1(MDP):
     
     def get_reward(self, state, action, rewards_matrix):
         # Define rewards for each state-action pair
-        # rewards_matrix = mdp.get_rewards_matrix()
+        # rewards_matrix = self.get_rewards_matrix()
         rewards_matrix = rewards_matrix
         # print(state)
         # print(action)
@@ -218,131 +220,146 @@ class MDP_Scenario1(MDP):
         # print(sum_rewards)
         return sum_rewards
 
-    def value_iteration(self, rewards_matrix, epsilon=0.001):
+    def value_iteration(self, rewards_matrix, epsilon=0.001, stopping='residual'):
+        # stopping: a rule name, a sequence of them or a Utils.StoppingRules; rules other than
+        # 'residual' use synchronous sweeps, self.stopped_by tells which rule fired
         # initialize V with 0
-        V = {mdp.get_state_hash(s): 0 for s in mdp.get_state_space()}
-        # print(mdp.discount)
-        # # while True:
-        # delta = 0
-        # for s in mdp.get_state_space():
-        #     s_hash = mdp.get_state_hash(s)
-        #     v = V[s_hash]
-        #     # for R(s, a)
-        #     V[s_hash] = max([sum([mdp.get_transition_probability(s, a, s_prime) * (mdp.get_reward(s, a) + mdp.discount * V[mdp.get_state_hash(s_prime)]) for s_prime in mdp.get_state_space()]) for a in mdp.get_actions()])
-        #     # for R(s, a, s')
-        #     # V[s_hash] = max([mdp.discount * sum([mdp.get_transition_probability(s, a, s_prime) * (mdp.get_reward(s, a, s_prime) + V[mdp.get_state_hash(s_prime)]) for s_prime in mdp.get_state_space()]) for a in mdp.get_actions()])
-        #     delta = max(delta, abs(v - V[s_hash]))
-        #     #print(delta)
-        #     print("s :", s)
-        #     print("s_hash: ", s_hash)
-        #     print("v: ", v)
-        #     print("V[s_hash]: ", V[s_hash])
-        #     # if delta < epsilon:
-        #     #     break
+        V = {self.get_state_hash(s): 0 for s in self.get_state_space()}
+        rules = get_stopping_rules(stopping)
+        if rules.rules != ('residual',):
+            return self.value_iteration_with_rules(rewards_matrix, V, rules, epsilon)
+        # in-place sweeps in state order on the successor lists of the scanned model, which
+        # give the same sums as going through get_transition_probability for every s_prime
+        successors = self.get_scanned_transition_model().get_successor_lists()
+        rewards = self.get_reward_table(rewards_matrix).tolist()
+        V_list = [0 for _ in self.get_state_space()]
+        Q_list = [[0 for _ in successors[s_idx]] for s_idx in range(len(V_list))]
+        backup = _make_backup(successors, rewards, self.discount, V_list, Q_list)
         while True:
             delta = 0
-            for s in mdp.get_state_space():
-                s_hash = mdp.get_state_hash(s)
-                v = V[s_hash]
-                # for R(s, a)
-                V[s_hash] = max([sum([mdp.get_transition_probability(s, a, s_prime) * (mdp.get_reward(s, a, rewards_matrix) + mdp.discount * V[mdp.get_state_hash(s_prime)]) for s_prime in mdp.get_state_space()]) for a in mdp.get_actions()])
-                # for R(s, a, s')
-                # V[s_hash] = max([mdp.discount * sum([mdp.get_transition_probability(s, a, s_prime) * (mdp.get_reward(s, a, s_prime) + V[mdp.get_state_hash(s_prime)]) for s_prime in mdp.get_state_space()]) for a in mdp.get_actions()])
-                delta = max(delta, abs(v - V[s_hash]))
+            for s_idx in range(len(V_list)):
+                v = V_list[s_idx]
+                V_list[s_idx] = backup(s_idx)
+                delta = max(delta, abs(v - V_list[s_idx]))
             # print(delta)
             if delta < epsilon:
                 self.delta = delta
+                self.stopped_by = 'residual'
                 break
+        for s, v in zip(self.get_state_space(), V_list):
+            V[self.get_state_hash(s)] = v
         return V
+
+    def value_iteration_with_rules(self, rewards_matrix, V, rules, epsilon):
+        # synchronous sweeps on a compiled table, every Q reads the V of the previous sweep
+        states = self.get_state_space()
+        model = self.get_scanned_transition_model()
+        rewards = self.get_reward_table(rewards_matrix)[None]
+        V_array, Q_array = batch_value_iteration_on_model(model, rewards, self.discount, epsilon, stopping=rules)
+        self.stopped_by = rules.stopped_by[0]
+        self.delta = np.abs(Q_array[0].max(axis=1) - V_array[0]).max()
+        for s, v in zip(states, V_array[0].tolist()):
+            V[self.get_state_hash(s)] = v
+        return V
+
+    def get_scanned_transition_model(self):
+        # TransitionModel read off get_transition_probability, which (not get_next_state) is what
+        # value_iteration uses; scanned once per instance and kept
+        if getattr(self, 'scanned_transition_model', None) is None:
+            states = self.get_state_space()
+            indptr = [0]
+            indices = []
+            probs = []
+            for s in states:
+                for a in self.get_actions():
+                    for s_prime_idx, s_prime in enumerate(states):
+                        p = self.get_transition_probability(s, a, s_prime)
+                        if p != 0:
+                            indices.append(s_prime_idx)
+                            probs.append(p)
+                    indptr.append(len(indices))
+            state_index = {self.get_state_hash(s): s_idx for s_idx, s in enumerate(states)}
+            self.scanned_transition_model = TransitionModel(len(states), self.get_actions(), indptr, indices, probs,
+                                                            state_index)
+        return self.scanned_transition_model
+
+    def get_state_index(self, state):
+        # position of the state in get_state_space(), None for states outside of it
+        return self.get_scanned_transition_model().state_index.get(self.get_state_hash(state))
+
+    def get_reward_table(self, rewards_matrix):
+        # (states x actions) get_reward, weighted by the outgoing probability mass like the
+        # sums over s_prime do (actions without a successor are worth nothing)
+        model = self.get_scanned_transition_model()
+        return np.array([[self.get_reward(s, a, rewards_matrix) * sum(model.get_successors(s_idx, a_idx)[1])
+                          for a_idx, a in enumerate(self.get_actions())]
+                         for s_idx, s in enumerate(self.get_state_space())], dtype=np.float64)
+
+    def get_q_table(self, V, rewards_matrix):
+        # (states x actions) Q from a solved V ({s_hash: V}), in one pass over the scanned model
+        model = self.get_scanned_transition_model()
+        V_array = np.array([V[self.get_state_hash(s)] for s in self.get_state_space()], dtype=np.float64)
+        return self.get_reward_table(rewards_matrix) + self.discount * model.get_expected_values(V_array)
     
-    def get_policy(self, V, rewards_matrix):
-        # pass
-        # initialize P with None
-        P = {mdp.get_state_hash(s): None for s in mdp.get_state_space()}
-        for s in mdp.get_state_space():
-            s_hash = mdp.get_state_hash(s)
-            v = V[s_hash]
-            # for R(s, a)
-            # V[s_hash] = max([sum([mdp.get_transition_probability(s, a, s_prime) * (mdp.get_reward(s, a) + mdp.discount * V[mdp.get_state_hash(s_prime)]) for s_prime in mdp.get_state_space()]) for a in mdp.get_actions()])
-            max_value = float('-inf')
-            best_action = None
-            for a in mdp.get_actions():
-                value = sum([mdp.get_transition_probability(s, a, s_prime) * 
-                            (mdp.get_reward(s, a, rewards_matrix) + mdp.discount * V[mdp.get_state_hash(s_prime)]) 
-                            for s_prime in mdp.get_state_space()])
-                if value >= max_value:
-                    max_value = value
-                    best_action = a
-                # How if there are multiple actions that give max expected value?
-                # Currently, select the action in the latest order
-                # Next, should be able to get all possible trajectories
-            V[s_hash] = max_value
-            P[s_hash] = best_action
-            delta = max(self.delta, abs(v - V[s_hash]))
+    def get_policy(self, V, rewards_matrix, Q=None):
+        # greedy action in every state, Q is the get_q_table of V (computed here if not given).
+        # How if there are multiple actions that give max expected value?
+        # Currently, select the action in the latest order like Utils.get_greedy_actions does for
+        # every domain; check_possible_policies looks at all of them
+        if Q is None:
+            Q = self.get_q_table(V, rewards_matrix)
+        actions = self.get_actions()
+        best_actions = get_greedy_actions(Q)
+        P = {self.get_state_hash(s): actions[a_idx] for s, a_idx in zip(self.get_state_space(), best_actions.tolist())}
         P['Terminate'] = "None"
-        # self.P = P
-        # print("delta: ", delta)
-        # print("V: ", V)
-        # print("P: ", P)
         return P
 
-    def check_possible_policies(self, V, rewards_matrix, T_video):
+    def check_possible_policies(self, V, rewards_matrix, T_video, Q=None):
+        # Q is the get_q_table of V (computed here if not given), the states of T_video are
+        # looked up in it directly
         print("Checking the policy:")
+        if Q is None:
+            Q = self.get_q_table(V, rewards_matrix)
+        actions = self.get_actions()
         result = "-"
         continue_check = True
-        # initialize P with None
-        P = {mdp.get_state_hash(s): None for s in mdp.get_state_space()}
         i = 0
         for sa in T_video:
             s_video = sa[0]
             a_video = sa[1]
             # print(s_video, a_video)
-            for s in mdp.get_state_space():
-                if (s_video == s) and (continue_check == True):
-                    # print(s_video, a_video)
-                    i = i + 1
-                    print(i, " Correct (s,a): ", mdp.decode_state(s_video), " -> ", mdp.decode_actions(a_video))
-                    s_hash = mdp.get_state_hash(s)
-                    v = V[s_hash]
-                    max_value = float('-inf')
-                    list_best_action = []
-                    if s_video != "Terminate":
-                        # Get max expected value from all possible actions
-                        for a in mdp.get_actions():
-                            value = sum([mdp.get_transition_probability(s, a, s_prime) * 
-                                        (mdp.get_reward(s, a, rewards_matrix) + mdp.discount * V[mdp.get_state_hash(s_prime)]) 
-                                        for s_prime in mdp.get_state_space()])
-                            if value >= max_value:
-                                max_value = value
-                        # Get all actions that return max expected value
-                        for a in mdp.get_actions():
-                            value = sum([mdp.get_transition_probability(s, a, s_prime) * 
-                                        (mdp.get_reward(s, a, rewards_matrix) + mdp.discount * V[mdp.get_state_hash(s_prime)]) 
-                                        for s_prime in mdp.get_state_space()])
-                            if value == max_value:
-                                list_best_action.append(a)
-                    else:
-                        list_best_action.append("None")
-                    print("List best actions in s based on value iteration: ")
-                    for best_action in (list_best_action):
-                        print(mdp.decode_actions(best_action))
-                    # Check if the current action to be done (a_video) is in the list (list_best_action)
-                    # 1. It is not, then it is misspecified.
-                    # 2. It is, but there is another action with the same value, then underspecified.
-                    # 3. It is, and the only one, then correct specification.
-                    # Current action is not found
-                    if list_best_action.count(a_video) == 0: 
-                        result = "misspecified"
-                        continue_check = False
-                    # Current action is found, but there is another action with the same value
-                    elif (list_best_action.count(a_video) > 0) and (len(list_best_action) >=2):
-                        result = "underspecified"
-                        continue_check = True
-                    # Condition for correct specification
-                    elif (list_best_action.count(a_video) > 0) and (len(list_best_action) == 1) and (a_video == "None") and (result != "underspecified"):
-                        result = "correct"
-                        continue_check = False
-                    print("Current result: ", result)
+            s_idx = self.get_state_index(s_video)
+            if (s_idx is None) or (continue_check == False):
+                continue
+            i = i + 1
+            print(i, " Correct (s,a): ", self.decode_state(s_video), " -> ", self.decode_actions(a_video))
+            list_best_action = []
+            if s_video != "Terminate":
+                # all actions that return the max expected value
+                max_value = Q[s_idx].max()
+                list_best_action = [a for a, value in zip(actions, Q[s_idx].tolist()) if value == max_value]
+            else:
+                list_best_action.append("None")
+            print("List best actions in s based on value iteration: ")
+            for best_action in (list_best_action):
+                print(self.decode_actions(best_action))
+            # Check if the current action to be done (a_video) is in the list (list_best_action)
+            # 1. It is not, then it is misspecified.
+            # 2. It is, but there is another action with the same value, then underspecified.
+            # 3. It is, and the only one, then correct specification.
+            # Current action is not found
+            if list_best_action.count(a_video) == 0:
+                result = "misspecified"
+                continue_check = False
+            # Current action is found, but there is another action with the same value
+            elif (list_best_action.count(a_video) > 0) and (len(list_best_action) >=2):
+                result = "underspecified"
+                continue_check = True
+            # Condition for correct specification
+            elif (list_best_action.count(a_video) > 0) and (len(list_best_action) == 1) and (a_video == "None") and (result != "underspecified"):
+                result = "correct"
+                continue_check = False
+            print("Current result: ", result)
         return result
 
     def get_trajectory(self, init_state, P):
@@ -353,11 +370,11 @@ class MDP_Scenario1(MDP):
         max_steps = 10
         t = 0
         while ((t < max_steps)):
-            s_hash = mdp.get_state_hash(state)
+            s_hash = self.get_state_hash(state)
             action = P[s_hash]
             trajectory.append((state, action))
             # To get the full trajectory, we need to know the next_state after execute the (state, action)
-            next_state = mdp.get_next_state(state, action)
+            next_state = self.get_next_state(state, action)
             if (next_state == "Terminate"):
                 trajectory.append((next_state, "None"))
                 break
@@ -517,11 +534,12 @@ if __name__ == "__main__":
             for row in rewards:
                     print(row)
 
-            # Call value iteration
+            # Call value iteration, the Q table is computed once for the policy and the check
             V = mdp.value_iteration(rewards)
+            Q = mdp.get_q_table(V, rewards)
 
             # Call get_policy
-            P = mdp.get_policy(V, rewards)
+            P = mdp.get_policy(V, rewards, Q)
 
             # Call get_trajectory
             init_state = mdp.get_init_state()
@@ -538,7 +556,7 @@ if __name__ == "__main__":
             # mdp.compare_trajectories(T, T_video)
 
             # Check whether the video trajectory is the subset of all possible trajectories generated from the user-defined matrix
-            result = mdp.check_possible_policies(V, rewards, T_video)
+            result = mdp.check_possible_policies(V, rewards, T_video, Q)
             if result == "correct":
                 print("CORRECT SPECIFICATION")
             elif result == "underspecified":
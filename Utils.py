@@ -1,5 +1,15 @@
+import hashlib
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
 from itertools import chain, combinations
 
+import numpy as np
+
+from results import SolveResult, get_solution_key
+
 def powerset(iterable):
     "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
     s = list(iterable)
@@ -9,34 +19,176 @@ def powerset(iterable):
 
 
 
-def test_specification(mdp, trajectory, participant_id=0):
-    initial_state = mdp.get_init_state()
-    current_state = initial_state
+class OptimalActionGraph(object):
+    # Tie-aware view of a solved Q table: for every state reachable from init_state through
+    # optimal actions, all actions whose Q is within tolerance of the maximum and the states
+    # they lead to. States are expanded on first access, so walking one trajectory only
+    # looks at the states on it. Actions the solver eliminated as provably suboptimal
+    # (value_iteration with method='action_elimination') are skipped without looking at Q,
+    # and a state with a single surviving action has no ties. mdp may also be a CompiledMDP,
+    # with the solution given as Q or as a SolveResult.
+    def __init__(self, mdp, participant_id=0, tolerance=1e-9, Q=None, eliminated=None, result=None):
+        self.mdp = mdp
+        self.model = mdp.transition_model
+        if result is not None:
+            Q = result.Q
+            eliminated = result.eliminated
+        # (states x actions) Q of the participant, rows in get_state_space() order; taken from
+        # the stored solutions unless given, and so is the eliminated mask
+        if Q is None:
+            self.Q = mdp.Q.get_array()[participant_id]
+            if eliminated is None:
+                eliminated = getattr(mdp, 'eliminated_actions', {}).get(participant_id)
+        else:
+            self.Q = np.asarray(Q)
+        self.eliminated = eliminated
+        self.tolerance = tolerance
+        self.absorbing = self.model.get_absorbing_states()
+        self.init_index = mdp.get_state_index(mdp.get_init_state())
+        self._edges = {}
+
+    def get_optimal_actions(self, s_idx):
+        return [a for a, _ in self.get_edges(s_idx)]
+
+    def get_edges(self, s_idx):
+        # [(optimal action, [successor indices]), ...] in action order
+        if s_idx not in self._edges:
+            if self.eliminated is None:
+                a_indices = range(self.model.n_actions)
+            else:
+                a_indices = np.flatnonzero(~self.eliminated[s_idx]).tolist()
+            if len(a_indices) > 1:
+                q_row = self.Q[s_idx]
+                max_value = q_row.max()
+                a_indices = [a_idx for a_idx in a_indices if q_row[a_idx] >= max_value - self.tolerance]
+            self._edges[s_idx] = [(self.model.actions[a_idx], self.model.get_successors(s_idx, a_idx)[0].tolist())
+                                  for a_idx in a_indices]
+        return self._edges[s_idx]
+
+    def get_next_state_index(self, s_idx, action):
+        # first successor of an optimal action, None if the action is not optimal in s_idx
+        for a, next_indices in self.get_edges(s_idx):
+            if a == action:
+                return next_indices[0] if next_indices else s_idx
+        return None
+
+    def is_terminal(self, s_idx):
+        return self.absorbing[s_idx]
+
+    def get_reachable_graph(self):
+        # the whole DAG as {state index: [(action, [successor indices]), ...]}
+        graph = {}
+        stack = [self.init_index]
+        while stack:
+            s_idx = stack.pop()
+            if s_idx in graph:
+                continue
+            graph[s_idx] = self.get_edges(s_idx)
+            if not self.is_terminal(s_idx):
+                for _, next_indices in graph[s_idx]:
+                    stack.extend(next_indices)
+        return graph
+
+    def iter_trajectories(self, max_steps=1000):
+        # lazily yields every optimal trajectory from init_state as a list of actions,
+        # each one ends when an absorbing state is reached (or after max_steps actions)
+        stack = [(self.init_index, [])]
+        while stack:
+            s_idx, trajectory = stack.pop()
+            if self.is_terminal(s_idx) or len(trajectory) >= max_steps:
+                yield trajectory
+                continue
+            # pushed in reverse so trajectories come out in action order
+            for a, next_indices in reversed(self.get_edges(s_idx)):
+                for s_prime_idx in reversed(next_indices):
+                    stack.append((s_prime_idx, trajectory + [a]))
+
+def get_optimal_action_graph(mdp, participant_id=0, tolerance=1e-9, Q=None, eliminated=None, result=None):
+    return OptimalActionGraph(mdp, participant_id=participant_id, tolerance=tolerance, Q=Q, eliminated=eliminated,
+                              result=result)
+
+def iter_optimal_trajectories(mdp, participant_id=0, tolerance=1e-9, max_steps=1000):
+    return get_optimal_action_graph(mdp, participant_id, tolerance).iter_trajectories(max_steps)
+
+def test_specification(mdp, trajectory, participant_id=0, tolerance=1e-9, Q=None, eliminated=None, result=None):
+    # (correct, underspecified): the trajectory is correct if every action is optimal along the
+    # way, and underspecified if some step had another optimal action (within tolerance) too.
+    # Q overrides the stored (states x actions) solution of participant_id, eliminated the
+    # mask of provably suboptimal actions that comes with it; result (a SolveResult) gives both.
+    graph = get_optimal_action_graph(mdp, participant_id, tolerance, Q, eliminated, result)
+    current_idx = graph.init_index
     correct_flag = True
     underspecified_flag = False
     for act in trajectory:
-        max_value = -1000
-        max_value_act_list = []
-        for a in mdp.get_actions():
-            curr_val = mdp.Q[participant_id][mdp.get_state_hash(current_state)][a]
-            if curr_val > max_value:
-                max_value = curr_val
-                max_value_act_list = [a]
-            elif curr_val == max_value:
-                max_value_act_list.append(a)
-
-        if mdp.Q[participant_id][mdp.get_state_hash(current_state)][act] != max_value:
+        next_idx = graph.get_next_state_index(current_idx, act)
+        if next_idx is None:
             return False, False
-
-        if len(max_value_act_list) > 1:
+        if len(graph.get_edges(current_idx)) > 1:
             underspecified_flag = True
-        for s_prime in mdp.get_state_space():
-            if mdp.get_transition_probability(current_state, act, s_prime) > 0:
-                current_state = s_prime
-                break
+        current_idx = next_idx
 
     return correct_flag, underspecified_flag
 
+class TrajectoryTrie(object):
+    # Candidate trajectories merged on their common prefixes, so a batch of them can be checked
+    # against a solution without walking any shared prefix twice. Node 0 is the root,
+    # children[node] maps an action to the next node and ends[node] holds the indices of the
+    # trajectories that end there. Built once, it can be reused for every participant.
+    def __init__(self, trajectories):
+        self.trajectories = [list(trajectory) for trajectory in trajectories]
+        self.children = [{}]
+        self.ends = [[]]
+        for t_idx, trajectory in enumerate(self.trajectories):
+            node = 0
+            for action in trajectory:
+                if action not in self.children[node]:
+                    self.children[node][action] = len(self.children)
+                    self.children.append({})
+                    self.ends.append([])
+                node = self.children[node][action]
+            self.ends[node].append(t_idx)
+
+    def __len__(self):
+        return len(self.trajectories)
+
+    def iter_trajectory_indices(self, node):
+        # indices of every trajectory ending at node or below it
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for t_idx in self.ends[node]:
+                yield t_idx
+            stack.extend(self.children[node].values())
+
+def test_specifications(mdp, trajectories, participant_id=0, tolerance=1e-9, Q=None, eliminated=None, result=None):
+    # test_specification for many candidate trajectories at once, e.g. alternative orderings
+    # or early exits. trajectories is a list of action lists or a TrajectoryTrie; the trie is
+    # walked once along the optimal action graph, so every shared prefix is checked once.
+    # Returns [(correct, underspecified, divergent_step), ...] in trajectory order, where
+    # (correct, underspecified) is what test_specification gives and divergent_step is the
+    # index of the first action that is not optimal (None for correct trajectories).
+    if not isinstance(trajectories, TrajectoryTrie):
+        trajectories = TrajectoryTrie(trajectories)
+    graph = get_optimal_action_graph(mdp, participant_id, tolerance, Q, eliminated, result)
+    verdicts = [None] * len(trajectories)
+    # (trie node, state index, underspecified so far, steps taken)
+    stack = [(0, graph.init_index, False, 0)]
+    while stack:
+        node, s_idx, underspecified_flag, step = stack.pop()
+        for t_idx in trajectories.ends[node]:
+            verdicts[t_idx] = (True, underspecified_flag, None)
+        if not trajectories.children[node]:
+            continue
+        has_ties = len(graph.get_edges(s_idx)) > 1
+        for act, child in trajectories.children[node].items():
+            next_idx = graph.get_next_state_index(s_idx, act)
+            if next_idx is None:
+                for t_idx in trajectories.iter_trajectory_indices(child):
+                    verdicts[t_idx] = (False, False, step)
+            else:
+                stack.append((child, next_idx, underspecified_flag or has_ties, step + 1))
+    return verdicts
+
 
 def rollout_policy(mdp, policy, max_steps=1000, participant_id=0):
     # pass
@@ -47,73 +199,853 @@ def rollout_policy(mdp, policy, max_steps=1000, participant_id=0):
         trajectory.append(a)
         if a == "None":
             break
-        for s_prime in mdp.get_state_space():
-            if mdp.get_transition_probability(s, a, s_prime) > 0:
-                s = s_prime
-                break
+        s = mdp.get_next_state_from_model(s, a)
         if a == "Exit the task":
             break
         #s = mdp.get_next_state(s, a)
     return trajectory
 
-def value_iteration(mdp, epsilon=0.001, participant_id=0):
-    mdp.V.append({mdp.get_state_hash(s): 0 for s in mdp.get_state_space()})
-    mdp.Q.append({mdp.get_state_hash(s): {} for s in mdp.get_state_space()})
+class SolveRecord(object):
+    # Instrumentation of one solver call, created by SolverStats.start():
+    #   sweeps / residuals     - number of sweeps and the max |V change| of each one
+    #   backups                - Bellman backups of a single state for a single participant
+    #   transition_evaluations - (action, successor) entries read by those backups
+    #   phase_seconds          - wall time per phase, in the order the phases ended
+    #   participant_sweeps     - batched value iteration only: sweeps until each participant converged
+    #   stopped_by             - the stopping rule that ended each participant
+    def __init__(self, solver, domain, participants, callback=None):
+        self.solver = solver
+        self.domain = domain
+        self.participants = participants
+        self.callback = callback
+        self.sweeps = 0
+        self.residuals = []
+        self.backups = 0
+        self.transition_evaluations = 0
+        self.phase_seconds = OrderedDict()
+        self.participant_sweeps = None
+        self.stopped_by = None
+        self._phase_start = time.perf_counter()
+
+    def add_sweep(self, residual, backups, transition_evaluations):
+        self.sweeps += 1
+        self.residuals.append(float(residual))
+        self.backups += int(backups)
+        self.transition_evaluations += int(transition_evaluations)
+        if self.callback is not None:
+            self.callback(self)
+
+    def add_backups(self, backups, transition_evaluations):
+        self.backups += int(backups)
+        self.transition_evaluations += int(transition_evaluations)
+
+    def end_phase(self, name):
+        # closes the phase that started when the previous one ended (or at creation)
+        now = time.perf_counter()
+        self.phase_seconds[name] = self.phase_seconds.get(name, 0) + now - self._phase_start
+        self._phase_start = now
+
+    def get_seconds(self):
+        return sum(self.phase_seconds.values())
+
+    def as_dict(self):
+        return {'solver': self.solver, 'domain': self.domain, 'participants': self.participants,
+                'sweeps': self.sweeps, 'residuals': self.residuals, 'backups': self.backups,
+                'transition_evaluations': self.transition_evaluations,
+                'phase_seconds': dict(self.phase_seconds), 'seconds': self.get_seconds(),
+                'participant_sweeps': None if self.participant_sweeps is None else
+                self.participant_sweeps.tolist(), 'stopped_by': self.stopped_by}
+
+class SolverStats(object):
+    # Opt-in collector for the solvers: pass one as stats=... to value_iteration,
+    # backward_induction, incremental_value_iteration or the batch solvers and every call
+    # appends a SolveRecord to records. callback(record), if given, runs after each sweep,
+    # e.g. to print the residual of a slow solve as it goes. Without stats the solvers only
+    # pay an 'is None' check per sweep.
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+
+    def start(self, solver, mdp, participants):
+        # mdp is a domain or its CompiledMDP
+        domain = getattr(mdp, 'domain_name', type(mdp).__name__) if mdp is not None else None
+        record = SolveRecord(solver, domain, list(participants), callback=self.callback)
+        self.records.append(record)
+        return record
+
+    def get_totals(self, key='domain'):
+        # {key value: {'solves', 'seconds', 'sweeps', 'backups', 'transition_evaluations'}},
+        # key is any SolveRecord attribute, e.g. 'domain' or 'solver'
+        totals = OrderedDict()
+        for record in self.records:
+            total = totals.setdefault(getattr(record, key), {'solves': 0, 'seconds': 0, 'sweeps': 0, 'backups': 0,
+                                                            'transition_evaluations': 0})
+            total['solves'] += 1
+            total['seconds'] += record.get_seconds()
+            total['sweeps'] += record.sweeps
+            total['backups'] += record.backups
+            total['transition_evaluations'] += record.transition_evaluations
+        return totals
+
+    def get_slowest(self, n=10):
+        # the n records with the largest wall time
+        return sorted(self.records, key=lambda record: record.get_seconds(), reverse=True)[:n]
+
+    def clear(self):
+        self.records = []
+
+def _start_record(stats, solver, mdp, participants):
+    # None when instrumentation is off, so the solvers can test 'record is not None'
+    if stats is None:
+        return None
+    return stats.start(solver, mdp, participants)
+
+def _count_backups(backup, record, transition_counts):
+    # wraps backup() so every call is added to the record
+    def counted_backup(s_idx):
+        record.add_backups(1, transition_counts[s_idx])
+        return backup(s_idx)
+    return counted_backup
+
+class StoppingRules(object):
+    # Convergence tests for synchronous value iteration, checked after every sweep on arrays with
+    # a leading participant axis: V is the value function the sweep started from and Q the
+    # backups computed from it. With d = max_a Q - V, V* lies between V + min(d) / (1 - discount)
+    # and V + max(d) / (1 - discount), which is what the rules certify:
+    #   'residual' - max |d| < epsilon, the classic test
+    #   'bound'    - max |d| < epsilon * (1 - discount) / discount, so max_a Q is within epsilon of V*
+    #   'span'     - (max d - min d) * discount / (1 - discount) < epsilon, so max_a Q is within
+    #                epsilon of V* up to a constant offset, which moves no greedy action or tie
+    #   'policy'   - the greedy action sets (ties within tolerance) were unchanged for
+    #                stable_sweeps sweeps and are certified optimal. When the solver passes an
+    #                exact policy evaluator (deterministic models) the greedy policy is evaluated
+    #                and certified if no action improves on it, its values then replace V and Q
+    #                (and seed the next sweeps if it is not optimal yet); otherwise every other
+    #                action must trail the greedy ones by more than the
+    #                (max d - min d) * discount / (1 - discount) the bounds leave open.
+    # The first listed rule that holds stops a participant. stopped_by and sweeps tell, per
+    # participant of the last solve, which rule fired and after how many sweeps.
+    def __init__(self, rules=('residual',), stable_sweeps=3, tolerance=1e-9):
+        if isinstance(rules, str):
+            rules = (rules,)
+        for rule in rules:
+            if rule not in STOPPING_RULES:
+                raise ValueError("Unknown stopping rule: " + str(rule))
+        self.rules = tuple(rules)
+        self.stable_sweeps = stable_sweeps
+        self.tolerance = tolerance
+        self.stopped_by = []
+        self.sweeps = []
+
+    def start(self, n_participants, epsilon, discount, evaluate=None):
+        # evaluate(participant, policy) -> (V, Q) of that policy, or None if exact evaluation
+        # is not available
+        self.epsilon = epsilon
+        self.discount = discount
+        self.evaluate = evaluate
+        self.stopped_by = [None] * n_participants
+        self.sweeps = [0] * n_participants
+        self.stable = np.zeros(n_participants, dtype=np.int64)
+        self.previous_greedy = None
+        # participant -> (V, Q) the solver has to take over after check()
+        self.replacements = {}
+
+    def check(self, V, Q, participants):
+        # boolean mask of the rows (participants, indices into the batch) that may stop
+        participants = np.asarray(participants)
+        TV = Q.max(axis=-1)
+        d = TV - V
+        max_d = d.max(axis=1)
+        min_d = d.min(axis=1)
+        residual = np.maximum(np.abs(max_d), np.abs(min_d))
+        open_width = (max_d - min_d) * self.discount / (1 - self.discount)
+        fired = np.full(len(participants), -1)
+        for rule_idx, rule in enumerate(self.rules):
+            if rule == 'residual':
+                holds = residual < self.epsilon
+            elif rule == 'bound':
+                holds = residual < self.epsilon * (1 - self.discount) / self.discount
+            elif rule == 'span':
+                holds = open_width < self.epsilon
+            else:
+                holds = self._check_policy(Q, TV, open_width, participants)
+            fired = np.where((fired < 0) & holds, rule_idx, fired)
+        for row_idx, participant in enumerate(participants.tolist()):
+            self.sweeps[participant] += 1
+            if fired[row_idx] >= 0:
+                self.stopped_by[participant] = self.rules[fired[row_idx]]
+        return fired >= 0
+
+    def _check_policy(self, Q, TV, open_width, participants):
+        greedy = Q >= TV[..., None] - self.tolerance
+        if self.previous_greedy is None:
+            self.previous_greedy = np.zeros((len(self.stopped_by),) + Q.shape[1:], dtype=bool)
+            same = np.zeros(len(participants), dtype=bool)
+        else:
+            same = (greedy == self.previous_greedy[participants]).all(axis=(1, 2))
+        self.stable[participants] = np.where(same, self.stable[participants] + 1, 0)
+        self.previous_greedy[participants] = greedy
+        stable = self.stable[participants] >= self.stable_sweeps
+        if self.evaluate is None:
+            gap = np.where(greedy, np.inf, TV[..., None] - Q).min(axis=(1, 2))
+            return stable & (gap > open_width)
+        holds = np.zeros(len(participants), dtype=bool)
+        for row_idx in np.flatnonzero(stable).tolist():
+            participant = int(participants[row_idx])
+            V_policy, Q_policy = self.evaluate(participant, Q[row_idx].argmax(axis=-1))
+            # no action improves on the policy anywhere: it is optimal and V_policy is V*
+            optimal = bool((Q_policy.max(axis=-1) <= V_policy + self.tolerance).all())
+            self.replacements[participant] = (V_policy, Q_policy)
+            holds[row_idx] = optimal
+            # the next evaluation waits for another stable_sweeps sweeps
+            self.stable[participant] = 0
+        return holds
+
+    def stop_exact(self, participants):
+        # for solvers that compute V* in a single exact pass (backward induction): V* satisfies
+        # every rule, so the first listed one stops each participant after that pass
+        for participant in participants:
+            self.sweeps[participant] = 1
+            self.stopped_by[participant] = self.rules[0]
+
+    def take_replacements(self):
+        # {participant: (V, Q)} computed by the last check(), for the solver to take over
+        replacements = self.replacements
+        self.replacements = {}
+        return replacements
+
+STOPPING_RULES = ('residual', 'bound', 'span', 'policy')
+
+def get_stopping_rules(stopping):
+    # a StoppingRules from a rule name, a sequence of names or an existing instance
+    if isinstance(stopping, StoppingRules):
+        return stopping
+    return StoppingRules(stopping)
+
+def get_policy_evaluator(model, rewards, discount):
+    # evaluate(participant, policy) -> exact (V, Q) of a policy given as action indices, for
+    # StoppingRules; None unless the model is deterministic
+    if not model.is_deterministic():
+        return None
+
+    def evaluate(participant, policy):
+        V = model.evaluate_policy(policy, rewards[participant], discount)
+        return V, rewards[participant] + discount * model.get_expected_values(V)
+    return evaluate
 
+def value_iteration(mdp, epsilon=0.001, participant_id=0, method='sweep', stats=None, stopping='residual'):
+    # solve() on the compiled model of mdp with the stored rewards of participant_id; the
+    # solution is appended to mdp.V and mdp.Q and the rule that fired kept in
+    # mdp.stopped_by[participant_id]. See solve for method and stopping.
+    result = solve(mdp.get_compiled_model(), mdp.get_reward_tensor([participant_id])[0], participant_id=participant_id,
+                   method=method, epsilon=epsilon, stopping=stopping, stats=stats)
+    _store_result(mdp, result)
+    return mdp.V, mdp.Q
+
+def _store_result(mdp, result):
+    # appends a SolveResult to the solution store of mdp, as the mdp-level solvers always did
+    if getattr(mdp, 'stopped_by', None) is None:
+        mdp.stopped_by = {}
+    mdp.stopped_by[result.participant_id] = result.stopped_by
+    mdp.V.append(result.V)
+    mdp.Q.append(result.Q)
+    # tie detection reads the eliminated actions of the stored row, if there are any
+    if result.eliminated is not None:
+        mdp.eliminated_actions[len(mdp.Q) - 1] = result.eliminated
+    if result.record is not None:
+        result.record.end_phase('store')
+
+def solve(model, rewards, participant_id=None, method='sweep', epsilon=0.001, stopping='residual', stats=None):
+    # Solves one participant on a CompiledMDP and returns a SolveResult; nothing is written to
+    # the model, so threads can call this concurrently on the same one. rewards is the
+    # (states x actions) reward table, participant_id only labels the result.
+    # method selects the update schedule, all of them update V in place:
+    #   'sweep'        - states in get_state_space() order
+    #   'gauss_seidel' - states ordered so that successors are backed up before their predecessors
+    #   'prioritized'  - prioritized sweeping, the state with the largest Bellman error is backed
+    #                    up next and only the predecessors of changed states are re-queued
+    #   'action_elimination' - 'gauss_seidel' that stops backing up actions once the error
+    #                    bound of V proves them suboptimal (see _action_elimination); the
+    #                    eliminated actions come back in result.eliminated for tie detection
+    #   'backward_induction' - one exact pass in reverse topological order (see
+    #                    backward_induction), 'sweep' when the graph has a cycle
+    # stopping is a rule name, a sequence of them or a StoppingRules (see there). Any rule but
+    # the default 'residual' switches to synchronous sweeps, where its bounds hold, so method
+    # no longer matters; the rule that fired is result.stopped_by.
+    # stats is an optional SolverStats collector
+    if method not in ('sweep', 'gauss_seidel', 'prioritized', 'action_elimination', 'backward_induction'):
+        raise ValueError("Unknown value iteration method: " + str(method))
+    rules = get_stopping_rules(stopping)
+    if method in ('prioritized', 'action_elimination', 'backward_induction') and rules.rules != ('residual',):
+        raise ValueError("Method " + method + " only supports the 'residual' stopping rule")
+    transition_model = model.transition_model
+    order = None
+    if method == 'backward_induction':
+        order = transition_model.get_reverse_topological_order()
+        if order is None:
+            method = 'sweep'
+    solver = 'backward_induction' if order is not None else 'value_iteration:' + method
+    record = _start_record(stats, solver, model, [] if participant_id is None else [participant_id])
+    n_states = model.n_states
+    # successors[s_idx][a_idx] -> (successor indices, probabilities), compiled once per domain
+    successors = transition_model.get_successor_lists()
+    rewards = np.asarray(rewards, dtype=np.float64).tolist()
+    V = [0 for _ in range(n_states)]
+    Q = [[0 for _ in range(model.n_actions)] for _ in range(n_states)]
+    backup = _make_backup(successors, rewards, model.discount, V, Q)
+    eliminated = None
+    if record is not None:
+        transition_counts = transition_model.get_transition_counts()
+        record.end_phase('setup')
+
+    if order is not None:
+        _backward_induction(successors, backup, rewards, model.discount, V, order)
+        if record is not None:
+            # a single pass, nothing is left to converge
+            record.add_sweep(0, len(order), transition_model.indptr[-1])
+        stopped_by = 'residual'
+    elif method == 'prioritized':
+        if record is not None:
+            backup = _count_backups(backup, record, transition_counts)
+        _prioritized_sweeping(transition_model, V, backup, epsilon)
+        # Q for the final V
+        for s_idx in range(n_states):
+            backup(s_idx)
+        stopped_by = 'residual'
+    elif method == 'action_elimination':
+        eliminated = _action_elimination(transition_model, rewards, model.discount, V, Q, epsilon, record)
+        stopped_by = 'residual'
+    elif rules.rules != ('residual',):
+        rules.start(1, epsilon, model.discount,
+                    get_policy_evaluator(transition_model, np.array([rewards]), model.discount))
+        while True:
+            # every backup reads the V of the previous sweep
+            TV = [backup(s_idx) for s_idx in range(n_states)]
+            stop = rules.check(np.array([V]), np.array([Q]), [0])[0]
+            if record is not None:
+                record.add_sweep(max(abs(tv - v) for tv, v in zip(TV, V)), n_states, transition_model.indptr[-1])
+            V[:] = TV
+            # the exactly evaluated greedy policy replaces the iterate
+            for V_policy, Q_policy in rules.take_replacements().values():
+                V[:] = V_policy.tolist()
+                Q[:] = Q_policy.tolist()
+            if stop:
+                break
+        stopped_by = rules.stopped_by[0]
+    else:
+        if method == 'gauss_seidel':
+            sweep_order = transition_model.get_sweep_order()
+        else:
+            sweep_order = range(n_states)
+        while True:
+            delta = 0
+            for s_idx in sweep_order:
+                v = V[s_idx]
+                V[s_idx] = backup(s_idx)
+                delta = max(delta, abs(v - V[s_idx]))
+            if record is not None:
+                record.add_sweep(delta, len(sweep_order), transition_model.indptr[-1])
+            if delta < epsilon:
+                break
+        stopped_by = 'residual'
+    Q = np.array(Q, dtype=np.float64)
+    if record is not None:
+        record.stopped_by = [stopped_by]
+        record.end_phase('solve')
+    return SolveResult(model, V, Q, get_greedy_actions(Q), participant_id=participant_id, solver=solver,
+                       stopped_by=stopped_by, eliminated=eliminated, record=record)
+
+def _action_elimination(model, rewards, discount, V, Q, epsilon, record=None, tolerance=1e-9):
+    # Value iteration that drops provably suboptimal actions, from bounds lower <= V* <= upper:
+    # an action with Q* <= upper_Q < lower(s) - tolerance is below V* by more than tolerance, so
+    # it is never backed up again and never counts as a tie within tolerance, while the fixed
+    # point stays V*. On deterministic models the bounds come from the greedy policy, evaluated
+    # exactly: V = V_pi is a lower bound and, with r the largest Bellman residual of V_pi,
+    # V_pi + r / (1 - discount) an upper one; each iteration is one backup from V_pi (policy
+    # iteration, so only a handful are needed). Otherwise Gauss-Seidel sweeps are used: a sweep
+    # that changed V by at most delta leaves every value within
+    # width = discount * delta / (1 - discount) of V*, and every Q within discount * width of Q*.
+    # Stops once the residual is below epsilon, fills V and Q (all actions, from the final V)
+    # and returns the (states x actions) boolean mask of the eliminated actions.
+    backup = _make_backup(model.get_successor_lists(), rewards, discount, V, Q)
+    # surviving[s_idx] -> action indices still in play
+    surviving = [list(range(model.n_actions)) for _ in range(model.n_states)]
+    if model.is_deterministic():
+        _eliminate_with_policy_bounds(model, backup, Q, surviving, rewards, discount, V, epsilon, record, tolerance)
+    else:
+        _eliminate_with_sweep_bounds(model, backup, Q, surviving, discount, V, epsilon, record, tolerance)
+    for s_idx in range(model.n_states):
+        backup(s_idx)
+    eliminated = np.ones((model.n_states, model.n_actions), dtype=bool)
+    for s_idx, a_indices in enumerate(surviving):
+        eliminated[s_idx, a_indices] = False
+    return eliminated
+
+def _get_surviving_transitions(model, s_idx, a_indices):
+    # (action, successor) entries read by a backup of those actions of s_idx
+    successors = model.get_successor_lists()
+    return sum([len(successors[s_idx][a_idx][0]) for a_idx in a_indices])
+
+def _get_surviving_q_rows(model, backup, Q, surviving):
+    # Q of the surviving actions of every state from V, and the transitions that took
+    q_rows = []
+    transition_evaluations = 0
+    for s_idx, a_indices in enumerate(surviving):
+        backup(s_idx, a_indices)
+        q_rows.append([Q[s_idx][a_idx] for a_idx in a_indices])
+        transition_evaluations += _get_surviving_transitions(model, s_idx, a_indices)
+    return q_rows, transition_evaluations
+
+def _eliminate_with_policy_bounds(model, backup, Q, surviving, rewards, discount, V, epsilon, record, tolerance):
+    # the first policy is greedy after one Gauss-Seidel sweep, which on acyclic models is
+    # already optimal
+    for s_idx in model.get_sweep_order():
+        V[s_idx] = backup(s_idx)
+    q_rows, transition_evaluations = _get_surviving_q_rows(model, backup, Q, surviving)
+    if record is not None:
+        record.add_sweep(max([abs(max(q_row) - v) for q_row, v in zip(q_rows, V)]), 2 * model.n_states,
+                         2 * transition_evaluations)
+    while True:
+        policy = [a_indices[q_row.index(max(q_row))] for a_indices, q_row in zip(surviving, q_rows)]
+        V[:] = model.evaluate_policy(policy, rewards, discount).tolist()
+        q_rows, transition_evaluations = _get_surviving_q_rows(model, backup, Q, surviving)
+        residual = max([max(q_row) - v for q_row, v in zip(q_rows, V)])
+        if record is not None:
+            # the policy evaluation counts as one single-action backup per state
+            record.add_sweep(residual, 2 * model.n_states, transition_evaluations + model.n_states)
+        if residual < epsilon:
+            break
+        # V is V_pi <= V*, and V* <= V + residual / (1 - discount)
+        margin = discount * residual / (1 - discount) + tolerance
+        for s_idx, q_row in enumerate(q_rows):
+            if len(q_row) > 1:
+                kept = [(a_idx, q) for a_idx, q in zip(surviving[s_idx], q_row) if q >= V[s_idx] - margin]
+                surviving[s_idx] = [a_idx for a_idx, _ in kept]
+                q_rows[s_idx] = [q for _, q in kept]
+
+def _eliminate_with_sweep_bounds(model, backup, Q, surviving, discount, V, epsilon, record, tolerance):
+    sweep_order = model.get_sweep_order()
+    width = float('inf')
     while True:
         delta = 0
-        for s in mdp.get_state_space():
-            s_hash = mdp.get_state_hash(s)
-            v = mdp.V[participant_id][s_hash]
-            # for R(s, a)
-            curr_max =-1000
-            for a in mdp.get_actions():
-            #     for s_old in mdp.get_state_space():
-            #         count = 0
-            #         max_reward = -1000
-            #         for s_prime in mdp.get_state_space():
-            #             if mdp.get_transition_probability(s_old, a, s_prime) > 0:
-            #                 count += 1
-            #                 max_reward = max(max_reward, mdp.get_reward(s_old, a))
-            #                 #print("s: ", s_old, "a: ", a, "s_prime: ", s_prime, "R: ", mdp.get_reward(s_old, a), "P: ", mdp.get_transition_probability(s_old, a, s_prime))
-            #         print("s: ", s_old, "a: ", a, "count: ", count)#, "max_reward: ", max_reward)
-            #
-            # exit(0)
-                mdp.Q[participant_id][s_hash][a] = mdp.get_reward(s, a, participant_id) + sum([ mdp.get_transition_probability(s, a, s_prime) *
-                                        (mdp.discount * mdp.V[participant_id][mdp.get_state_hash(s_prime)])
-                                        for s_prime in mdp.get_state_space()])
-                curr_max = max(curr_max, mdp.Q[participant_id][s_hash][a])
-                #print("s: ", s, "a: ", a, "Q: ", mdp.Q[s_hash][a])
-            mdp.V[participant_id][s_hash] = curr_max
-            # for R(s, a, s')
-            # V[s_hash] = max([mdp.discount * sum([mdp.get_transition_probability(s, a, s_prime) * (mdp.get_reward(s, a, s_prime) + V[mdp.get_state_hash(s_prime)]) for s_prime in mdp.get_state_space()]) for a in mdp.get_actions()])
-            delta = max(delta, abs(v - mdp.V[participant_id][s_hash]))
-        # print(delta)
+        transition_evaluations = 0
+        margin = 2 * discount * width + tolerance
+        for s_idx in sweep_order:
+            a_indices = surviving[s_idx]
+            max_value = backup(s_idx, a_indices)
+            transition_evaluations += _get_surviving_transitions(model, s_idx, a_indices)
+            if len(a_indices) > 1 and margin < float('inf'):
+                surviving[s_idx] = [a_idx for a_idx in a_indices if Q[s_idx][a_idx] >= max_value - margin]
+            delta = max(delta, abs(V[s_idx] - max_value))
+            V[s_idx] = max_value
+        if record is not None:
+            record.add_sweep(delta, len(sweep_order), transition_evaluations)
         if delta < epsilon:
-            # self.delta = delta
             break
-    return mdp.V, mdp.Q
+        width = min(discount * width, discount * delta / (1 - discount))
+
+def _make_backup(successors, rewards, discount, V, Q):
+    # backup(s_idx) refreshes the Q row of s_idx from the current V and returns its maximum;
+    # backup(s_idx, a_indices) only refreshes those actions and returns the maximum over them.
+    # Every scalar solver backs up through here.
+    def backup(s_idx, a_indices=None):
+        # for R(s, a)
+        q_row = Q[s_idx]
+        if a_indices is None:
+            a_indices = range(len(q_row))
+        for a_idx in a_indices:
+            next_indices, next_probs = successors[s_idx][a_idx]
+            q_row[a_idx] = rewards[s_idx][a_idx] + sum([p * (discount * V[s_prime_idx])
+                                                        for s_prime_idx, p in zip(next_indices, next_probs)])
+        if len(a_indices) == len(q_row):
+            return max(q_row)
+        return max([q_row[a_idx] for a_idx in a_indices])
+    return backup
+
+def _prioritized_sweeping(model, V, backup, epsilon, initial_states=None):
+    # Bellman-error priority queue (a max-heap through negated priorities). Entries are
+    # invalidated lazily: a popped entry only counts if it still matches priority[s_idx].
+    # Only initial_states (all states by default) are queued at the start.
+    predecessors = model.get_predecessor_lists()
+    priority = {}
+    heap = []
+    if initial_states is None:
+        initial_states = range(model.n_states)
+    for s_idx in initial_states:
+        error = abs(backup(s_idx) - V[s_idx])
+        if error >= epsilon:
+            priority[s_idx] = error
+            heap.append((-error, s_idx))
+    heapq.heapify(heap)
+    while heap:
+        neg_error, s_idx = heapq.heappop(heap)
+        if priority.get(s_idx) != -neg_error:
+            continue
+        del priority[s_idx]
+        V[s_idx] = backup(s_idx)
+        for pred_idx in predecessors[s_idx]:
+            error = abs(backup(pred_idx) - V[pred_idx])
+            if error >= epsilon:
+                priority[pred_idx] = error
+                heapq.heappush(heap, (-error, pred_idx))
+            elif pred_idx in priority:
+                del priority[pred_idx]
+
+def incremental_value_iteration(mdp, previous_V, previous_rewards, rewards, epsilon=0.001,
+                                discount=None, previous_discount=None, stats=None, participant_id=None):
+    # Warm-started re-solve after a participant's rewards (or the discount) changed. V is
+    # seeded from previous_V (state-indexed, or a {s_hash: V} mapping like mdp.V[pid]) and only the
+    # states whose (states x actions) reward row differs between previous_rewards and rewards
+    # are queued for prioritized sweeping; their predecessors follow as values move. A new
+    # discount queues every state. Returns V and Q as state-indexed lists. participant_id only
+    # labels the SolveRecord when stats is given.
+    record = _start_record(stats, 'incremental_value_iteration', mdp,
+                           [] if participant_id is None else [participant_id])
+    states = mdp.get_state_space()
+    if discount is None:
+        discount = mdp.discount
+    if previous_discount is None:
+        previous_discount = mdp.discount
+    if isinstance(previous_V, Mapping):
+        V = [previous_V[mdp.get_state_hash(s)] for s in states]
+    else:
+        V = list(previous_V)
+    rewards = np.asarray(rewards, dtype=np.float64)
+    if discount != previous_discount:
+        changed_states = range(len(states))
+    else:
+        changed_states = np.flatnonzero((rewards != np.asarray(previous_rewards)).any(axis=1)).tolist()
+    Q = [[0 for _ in mdp.get_actions()] for _ in states]
+    backup = _make_backup(mdp.transition_model.get_successor_lists(), rewards.tolist(), discount, V, Q)
+    if record is not None:
+        record.end_phase('setup')
+        backup = _count_backups(backup, record, mdp.transition_model.get_transition_counts())
+    _prioritized_sweeping(mdp.transition_model, V, backup, epsilon, initial_states=changed_states)
+    # Q for the final V
+    for s_idx in range(len(states)):
+        backup(s_idx)
+    if record is not None:
+        record.end_phase('solve')
+    return V, Q
+
+def update_participant_rewards(mdp, participant_id, reward_weights, epsilon=0.001, stats=None):
+    # What-if analysis on one solved participant: replaces its (actions x facts) reward
+    # matrix and re-solves incrementally from the stored solution, overwriting
+    # mdp.V[participant_id] and mdp.Q[participant_id]. Returns their updated views.
+    # Everything else derived from the old rewards is refreshed too: the eliminated actions
+    # are dropped (they may be optimal now), a stored policy row is recomputed and the
+    # stopping rule becomes the residual test of prioritized sweeping.
+    previous_rewards = mdp.get_reward_tensor([participant_id])[0]
+    mdp.set_participant_reward_weights(participant_id, reward_weights)
+    rewards = mdp.get_reward_tensor([participant_id])[0]
+    V, Q = incremental_value_iteration(mdp, mdp.V.get_array()[participant_id], previous_rewards, rewards,
+                                       epsilon=epsilon, stats=stats, participant_id=participant_id)
+    mdp.V[participant_id] = V
+    mdp.Q[participant_id] = Q
+    getattr(mdp, 'eliminated_actions', {}).pop(participant_id, None)
+    if participant_id < len(mdp.Policy):
+        mdp.Policy[participant_id] = get_greedy_actions(mdp.Q.get_array()[participant_id])
+    if getattr(mdp, 'stopped_by', None) is not None:
+        mdp.stopped_by[participant_id] = 'residual'
+    return mdp.V[participant_id], mdp.Q[participant_id]
+
+def backward_induction(mdp, epsilon=0.001, participant_id=0, stats=None):
+    # Exact solve for domains whose transition graph is acyclic apart from actions that
+    # loop back to the same state (task_complete is absorbing with zero reward): every state
+    # is backed up exactly once, after all of its successors. Falls back to value_iteration
+    # when the graph has a cycle. Same inputs and outputs as value_iteration.
+    return value_iteration(mdp, epsilon=epsilon, participant_id=participant_id, method='backward_induction',
+                           stats=stats)
+
+def _backward_induction(successors, backup, rewards, discount, V, order):
+    # fills V and Q (the ones backup writes) in place, visiting the states of order once
+    for s_idx in order:
+        self_loops = []
+        a_indices = []
+        for a_idx in range(len(successors[s_idx])):
+            if successors[s_idx][a_idx][0] == [s_idx]:
+                self_loops.append(a_idx)
+            else:
+                a_indices.append(a_idx)
+        curr_max = backup(s_idx, a_indices) if a_indices else float('-inf')
+        for a_idx in self_loops:
+            # staying forever is worth R / (1 - discount)
+            curr_max = max(curr_max, rewards[s_idx][a_idx] / (1 - discount))
+        V[s_idx] = curr_max
+        if self_loops:
+            backup(s_idx, self_loops)
+
+def batch_value_iteration(mdp, rewards, epsilon=0.001, stats=None, stopping='residual'):
+    # Synchronous Bellman backups for a whole cohort at once. rewards is a
+    # (participants x states x actions) tensor sharing the transition model of mdp.
+    # Returns V (participants x states), Q (participants x states x actions) and the
+    # greedy policy as action indices (participants x states). The rows are also
+    # appended to mdp.V and mdp.Q like value_iteration does. stopping as in value_iteration;
+    # pass a StoppingRules to read back which rule stopped each participant.
+    record = _start_record(stats, 'batch_value_iteration', mdp, range(len(rewards)))
+    V, Q = batch_value_iteration_on_model(mdp.transition_model, rewards, mdp.discount, epsilon, record=record,
+                                          stopping=stopping)
+    store_batch_solution(mdp, V, Q)
+    if record is not None:
+        record.end_phase('store')
+    return V, Q, get_greedy_actions(Q)
+
+def batch_value_iteration_on_model(model, rewards, discount, epsilon=0.001, record=None, stopping='residual'):
+    # the array kernel of batch_value_iteration, needs nothing but a TransitionModel;
+    # record is an optional SolveRecord
+    rewards = np.asarray(rewards, dtype=np.float64)
+    rules = get_stopping_rules(stopping)
+    rules.start(rewards.shape[0], epsilon, discount, get_policy_evaluator(model, rewards, discount))
+    V = np.zeros(rewards.shape[:2])
+    Q = rewards.copy()
+    # participants whose values have not converged yet
+    active = np.arange(rewards.shape[0])
+    if record is not None:
+        record.participant_sweeps = np.zeros(rewards.shape[0], dtype=np.int64)
+        record.end_phase('setup')
+    while active.size > 0:
+        Q_active = rewards[active] + discount * model.get_expected_values(V[active])
+        V_active = Q_active.max(axis=2)
+        delta = np.abs(V_active - V[active]).max(axis=1)
+        stop = rules.check(V[active], Q_active, active)
+        V[active] = V_active
+        Q[active] = Q_active
+        # the exactly evaluated greedy policies replace the iterates
+        for participant, (V_policy, Q_policy) in rules.take_replacements().items():
+            V[participant] = V_policy
+            Q[participant] = Q_policy
+        if record is not None:
+            record.participant_sweeps[active] += 1
+            record.add_sweep(delta.max(), active.size * model.n_states, active.size * model.indptr[-1])
+        active = active[~stop]
+    if record is not None:
+        record.stopped_by = list(rules.stopped_by)
+        record.end_phase('solve')
+    return V, Q
+
+def store_batch_solution(mdp, V, Q):
+    # append the rows of a batched solve to the array-backed mdp.V and mdp.Q
+    mdp.V.extend_array(V)
+    mdp.Q.extend_array(Q)
+
+def batch_backward_induction(mdp, rewards, epsilon=0.001, stats=None, stopping='residual'):
+    # backward_induction for a whole cohort: states are visited once in reverse topological
+    # order and each backup is vectorized over participants. Falls back to
+    # batch_value_iteration when the graph has a cycle. Same outputs as batch_value_iteration.
+    record = _start_record(stats, 'batch_backward_induction', mdp, range(len(rewards)))
+    V, Q = batch_backward_induction_on_model(mdp.transition_model, rewards, mdp.discount, epsilon, record=record,
+                                             stopping=stopping)
+    store_batch_solution(mdp, V, Q)
+    if record is not None:
+        record.end_phase('store')
+    return V, Q, get_greedy_actions(Q)
+
+def batch_backward_induction_on_model(model, rewards, discount, epsilon=0.001, record=None, stopping='residual'):
+    # the array kernel of batch_backward_induction, needs nothing but a TransitionModel;
+    # record is an optional SolveRecord. The single pass is exact, so stopping only decides
+    # which rule is reported (StoppingRules.stop_exact) unless the graph has a cycle
+    order = model.get_reverse_topological_order()
+    if order is None:
+        return batch_value_iteration_on_model(model, rewards, discount, epsilon=epsilon, record=record,
+                                              stopping=stopping)
+    rewards = np.asarray(rewards, dtype=np.float64)
+    rules = get_stopping_rules(stopping)
+    rules.start(rewards.shape[0], epsilon, discount)
+    V = np.zeros(rewards.shape[:2])
+    Q = rewards.copy()
+    successors = model.get_successor_lists()
+    if record is not None:
+        record.end_phase('setup')
+    for s_idx in order:
+        V[:, s_idx] = float('-inf')
+        self_loops = []
+        for a_idx in range(model.n_actions):
+            next_indices, next_probs = successors[s_idx][a_idx]
+            if next_indices == [s_idx]:
+                self_loops.append(a_idx)
+                V[:, s_idx] = np.maximum(V[:, s_idx], rewards[:, s_idx, a_idx] / (1 - discount))
+                continue
+            if next_indices:
+                Q[:, s_idx, a_idx] += V[:, next_indices] @ (discount * np.array(next_probs))
+            V[:, s_idx] = np.maximum(V[:, s_idx], Q[:, s_idx, a_idx])
+        for a_idx in self_loops:
+            Q[:, s_idx, a_idx] = rewards[:, s_idx, a_idx] + discount * V[:, s_idx]
+    rules.stop_exact(range(rewards.shape[0]))
+    if record is not None:
+        record.stopped_by = list(rules.stopped_by)
+        record.add_sweep(0, len(rewards) * len(order), len(rewards) * model.indptr[-1])
+        record.end_phase('solve')
+    return V, Q
+
+# batched solvers by name, each kernel is
+# (model, rewards, discount, epsilon, record=None, stopping='residual') -> (V, Q)
+BATCH_SOLVERS = {
+    'value_iteration': batch_value_iteration_on_model,
+    'backward_induction': batch_backward_induction_on_model,
+}
+
+def solve_cohort(model, rewards, solver='backward_induction', epsilon=0.001, participant_ids=None, stats=None,
+                 stopping='residual'):
+    # The batch solvers on a CompiledMDP: rewards is a (participants x states x actions)
+    # tensor, e.g. model.get_reward_tensor(weights), and the result a SolveResult per row
+    # labelled with participant_ids (the row numbers by default). Nothing is written to the
+    # model, so threads can solve chunks of a cohort concurrently (see parallel.py).
+    # stopping as in solve; the rule that stopped each row is its result.stopped_by.
+    if solver not in BATCH_SOLVERS:
+        raise ValueError("Unknown batch solver: " + str(solver))
+    if participant_ids is None:
+        participant_ids = range(len(rewards))
+    participant_ids = list(participant_ids)
+    record = _start_record(stats, 'solve_cohort:' + solver, model, participant_ids)
+    rules = get_stopping_rules(stopping)
+    V, Q = BATCH_SOLVERS[solver](model.transition_model, rewards, model.discount, epsilon, record=record,
+                                 stopping=rules)
+    policy = get_greedy_actions(Q)
+    stopped_by = rules.stopped_by
+    return [SolveResult(model, V[row_idx], Q[row_idx], policy[row_idx], participant_id=participant_id,
+                        solver=solver, stopped_by=stopped_by[row_idx], record=record)
+            for row_idx, participant_id in enumerate(participant_ids)]
+
+class SolveCache(object):
+    # LRU cache of single-participant solutions. Keys are (domain, model fingerprint,
+    # reward fingerprint, discount, epsilon, solver) and values are read-only (V, Q) rows.
+    # A lock keeps the LRU order consistent when threads share the cache.
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, V, Q):
+        V.flags.writeable = False
+        Q.flags.writeable = False
+        with self.lock:
+            self.entries[key] = (V, Q)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# shared by every cached_batch_solve call that does not bring its own cache
+SOLVE_CACHE = SolveCache()
+
+def get_reward_fingerprint(rewards):
+    # digest of one participant's (states x actions) reward table
+    return hashlib.sha1(np.ascontiguousarray(rewards, dtype=np.float64).tobytes()).hexdigest()
+
+def get_solver_key(solver, stopping='residual'):
+    # the solver entry of cache and database keys; stopping rules other than the default change
+    # the solutions, so they are part of it
+    rules = get_stopping_rules(stopping).rules
+    if rules == ('residual',):
+        return solver
+    return solver + ':' + '+'.join(rules)
+
+def cached_batch_solve(mdp, rewards, solver='backward_induction', epsilon=0.001, cache=None, stats=None,
+                       database=None, stopping='residual'):
+    # Same results as the batch solvers, but participants with identical reward tables are
+    # solved once: duplicate rows in the batch are collapsed first, and solutions seen by
+    # earlier calls are taken from the LRU cache, then from database (an optional
+    # results.SolutionDatabase kept across runs). Only the remaining distinct rows go
+    # through the BATCH_SOLVERS kernel, and are written back to both. stopping as in
+    # solve_cohort, the rule that stopped each participant ends up in record.stopped_by.
+    if cache is None:
+        cache = SOLVE_CACHE
+    model = mdp.transition_model
+    rewards = np.asarray(rewards, dtype=np.float64)
+    n_participants = rewards.shape[0]
+    record = _start_record(stats, 'cached_batch_solve:' + solver, mdp, range(n_participants))
+    if n_participants == 0:
+        # np.unique cannot collapse the rows of an empty cohort, there is nothing to solve
+        V = np.zeros(rewards.shape[:2])
+        Q = np.zeros(rewards.shape)
+        if record is not None:
+            record.end_phase('store')
+        return V, Q, get_greedy_actions(Q)
+    unique_rewards, inverse = np.unique(rewards.reshape(n_participants, -1), axis=0, return_inverse=True)
+    unique_rewards = unique_rewards.reshape((-1,) + rewards.shape[1:])
+    inverse = inverse.reshape(-1)
+    key_prefix = (type(mdp).__name__, model.get_fingerprint())
+    solver_key = get_solver_key(solver, stopping)
+    keys = [key_prefix + (get_reward_fingerprint(row), mdp.discount, epsilon, solver_key) for row in unique_rewards]
+
+    V_unique = np.zeros(unique_rewards.shape[:2])
+    Q_unique = np.zeros(unique_rewards.shape)
+    missing = []
+    for row_idx, key in enumerate(keys):
+        solution = cache.get(key)
+        if solution is None:
+            missing.append(row_idx)
+        else:
+            V_unique[row_idx], Q_unique[row_idx] = solution
+    if database is not None and missing:
+        domain_fingerprint = mdp.get_domain_fingerprint()
+        database_keys = {row_idx: get_solution_key(domain_fingerprint, keys[row_idx][2], mdp.discount, epsilon,
+                                                   solver_key)
+                         for row_idx in missing}
+        stored = database.get_many(database_keys.values())
+        for row_idx in missing:
+            if database_keys[row_idx] in stored:
+                V_unique[row_idx], Q_unique[row_idx] = stored[database_keys[row_idx]][:2]
+                cache.put(keys[row_idx], V_unique[row_idx].copy(), Q_unique[row_idx].copy())
+        missing = [row_idx for row_idx in missing if database_keys[row_idx] not in stored]
+    if record is not None:
+        record.end_phase('dedup')
+    if missing:
+        V_missing, Q_missing = BATCH_SOLVERS[solver](model, unique_rewards[missing], mdp.discount, epsilon,
+                                                     record=record, stopping=stopping)
+        V_unique[missing] = V_missing
+        Q_unique[missing] = Q_missing
+        for row_idx, V_row, Q_row in zip(missing, V_missing, Q_missing):
+            cache.put(keys[row_idx], V_row.copy(), Q_row.copy())
+        if database is not None:
+            database.put_many([(database_keys[row_idx], V_row, Q_row, get_greedy_actions(Q_row))
+                               for row_idx, V_row, Q_row in zip(missing, V_missing, Q_missing)])
+    if record is not None:
+        # the kernel reported sweeps and stopping rules per solved distinct row; cache hits took
+        # no sweeps and were stopped by 'cached'. Both go back to participant order.
+        if record.participant_sweeps is not None:
+            unique_sweeps = np.zeros(len(unique_rewards), dtype=np.int64)
+            unique_sweeps[missing] = record.participant_sweeps
+            record.participant_sweeps = unique_sweeps[inverse]
+        unique_stopped_by = np.full(len(unique_rewards), 'cached', dtype=object)
+        if missing:
+            unique_stopped_by[missing] = record.stopped_by
+        record.stopped_by = unique_stopped_by[inverse].tolist()
+
+    V = V_unique[inverse]
+    Q = Q_unique[inverse]
+    store_batch_solution(mdp, V, Q)
+    if record is not None:
+        record.end_phase('store')
+    return V, Q, get_greedy_actions(Q)
+
+def get_greedy_actions(Q):
+    # index of the best action along the last axis; ties go to the latest action like get_policy
+    n_actions = Q.shape[-1]
+    return n_actions - 1 - np.argmax(Q[..., ::-1], axis=-1)
 
 def get_policy(mdp, participant_id=0):
-    # pass
-    # initialize P with None
-    mdp.Policy.append({mdp.get_state_hash(s): None for s in mdp.get_state_space()})
-    for s in mdp.get_state_space():
-        s_hash = mdp.get_state_hash(s)
-        max_value = float('-inf')
-        best_action = None
-        for a in mdp.get_actions():
-            value = mdp.Q[participant_id][s_hash][a]
-            if value >= max_value:
-                max_value = value
-                best_action = a
-            # How if there are multiple actions that give max expected value?
-            # Currently, select the action in the latest order
-            # Next, should be able to get all possible trajectories
-        mdp.Policy[participant_id][s_hash] = best_action
-    mdp.Policy[participant_id]['Terminate'] = "None"
-    # self.P = P
-    # print("delta: ", delta)
-    # print("V: ", V)
-    # print("P: ", P)
-    return mdp.Policy[participant_id]
\ No newline at end of file
+    # greedy action in every state from the stored Q; when several actions give the max
+    # expected value the latest one in get_actions() order is kept (see OptimalActionGraph
+    # for all of them). Stored in mdp.Policy[participant_id], asking again overwrites the row
+    # instead of appending a new one.
+    policy = get_greedy_actions(mdp.Q.get_array()[participant_id])
+    if participant_id < len(mdp.Policy):
+        mdp.Policy[participant_id] = policy
+    else:
+        mdp.Policy.append(policy)
+    return mdp.Policy[participant_id]
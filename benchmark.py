@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import survey
+from navigation import Navigation
+from self_driving import SelfDriving
+from block_stacking import BlockStacking
+from synthetic import SyntheticDomain
+from Utils import (value_iteration, batch_value_iteration, batch_backward_induction, get_policy,
+                   test_specification, test_specifications, rollout_policy, TrajectoryTrie)
+
+SURVEY_FILE = '5.0 Prolific - Goals vs Rewards - Specify Objective_February 9, 2025_19.10.xlsx'
+SCENARIO_SURVEY_FILE = 'Goals vs Rewards Survey 3.0 - Specify Objective - Prolific_December 4, 2024_18.25.xlsx'
+
+DOMAINS = [
+    (Navigation, ['Pick up the suitcase outside the room', 'Open the door', 'Dropoff the suitcase inside the room', 'Exit the task']),
+    (SelfDriving, ['Pick up the passenger from the initial position', 'Drop off the passenger at the drop-off location', 'Go to the battery charging station', 'Exit the task']),
+    (BlockStacking, ['Swap A and B', 'Stack B on A', 'Exit the task']),
+]
+
+
+def time_call(function, repeat):
+    # best wall time of repeat calls, in seconds
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def make_cohort(mdp, n_participants, rng):
+    # resamples the survey responses (with replacement) into a cohort of n_participants
+    weights = mdp.reward_weights
+    rows = weights[rng.integers(0, len(weights), size=n_participants)]
+    reward_facts = [f_idx for f_idx, fact in enumerate(mdp.fact_list) if fact != mdp.terminal_fact]
+    mdp.set_reward_weights(rows[:, :, reward_facts].transpose(0, 2, 1).reshape(n_participants, -1))
+    mdp.init_solution_store(capacity=n_participants)
+
+
+def bench_solvers(mdp, target_trajectory, n_participants, repeat, per_participant_budget):
+    # the pure-Python per-participant solver is only timed while participants x states stays
+    # within per_participant_budget
+    results = []
+    rewards = mdp.get_reward_tensor()
+
+    def record(name, seconds, participants=n_participants):
+        results.append({'benchmark': name, 'cohort_size': participants, 'seconds': seconds,
+                        'seconds_per_participant': seconds / participants})
+
+    record('batch_value_iteration', time_call(lambda: (mdp.init_solution_store(capacity=n_participants),
+                                                       batch_value_iteration(mdp, rewards)), repeat))
+    record('batch_backward_induction', time_call(lambda: (mdp.init_solution_store(capacity=n_participants),
+                                                          batch_backward_induction(mdp, rewards)), repeat))
+    if n_participants * len(mdp.get_state_space()) <= per_participant_budget:
+        def solve_each(method):
+            mdp.init_solution_store(capacity=n_participants)
+            for participant_id in range(n_participants):
+                value_iteration(mdp, participant_id=participant_id, method=method)
+        record('value_iteration:action_elimination', time_call(lambda: solve_each('action_elimination'), repeat))
+        record('value_iteration', time_call(lambda: solve_each('sweep'), repeat))
+    else:
+        mdp.init_solution_store(capacity=n_participants)
+        batch_backward_induction(mdp, rewards)
+
+    def policies():
+        mdp.Policy.clear()
+        for participant_id in range(n_participants):
+            get_policy(mdp, participant_id=participant_id)
+    record('get_policy', time_call(policies, repeat))
+    if target_trajectory is not None:
+        record('test_specification', time_call(
+            lambda: [test_specification(mdp, target_trajectory, participant_id=participant_id)
+                     for participant_id in range(n_participants)], repeat))
+        # the target with every early exit, all checked in one walk per participant
+        candidates = TrajectoryTrie([target_trajectory[:i] + ['Exit the task'] for i in range(len(target_trajectory))] +
+                                    [target_trajectory])
+        record('test_specifications', time_call(
+            lambda: [test_specifications(mdp, candidates, participant_id=participant_id)
+                     for participant_id in range(n_participants)], repeat))
+    record('rollout_policy', time_call(
+        lambda: [rollout_policy(mdp, mdp.Policy[participant_id], participant_id=participant_id)
+                 for participant_id in range(n_participants)], repeat))
+    return results
+
+
+def run_domain_benchmarks(cohort_sizes, repeat, per_participant_budget, seed):
+    results = []
+    rng = np.random.default_rng(seed)
+    for domain_class, target_trajectory in DOMAINS:
+        mdp = domain_class(SURVEY_FILE)
+        info = {'domain': domain_class.__name__, 'n_facts': len(mdp.fact_list),
+                'n_states': len(mdp.get_state_space()), 'n_actions': len(mdp.get_actions())}
+        results.append(dict(info, benchmark='generate_state_space', cohort_size=None,
+                            seconds=time_call(mdp.generate_state_space, repeat)))
+        results.append(dict(info, benchmark='compile_transition_model', cohort_size=None,
+                            seconds=time_call(mdp.compile_transition_model, repeat)))
+        for n_participants in cohort_sizes:
+            make_cohort(mdp, n_participants, rng)
+            for result in bench_solvers(mdp, target_trajectory, n_participants, repeat, per_participant_budget):
+                results.append(dict(info, **result))
+    return results
+
+
+def run_ingestion_benchmarks(repeat):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        def cold():
+            survey.clear_loaded_surveys()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            survey.load_survey_rewards(SURVEY_FILE, cache_dir=cache_dir)
+
+        def cached():
+            survey.clear_loaded_surveys()
+            survey.load_survey_rewards(SURVEY_FILE, cache_dir=cache_dir)
+        return [{'benchmark': 'survey_ingestion_cold', 'domain': None, 'cohort_size': None,
+                 'seconds': time_call(cold, repeat)},
+                {'benchmark': 'survey_ingestion_cached', 'domain': None, 'cohort_size': None,
+                 'seconds': time_call(cached, repeat)}]
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def run_scaling_benchmarks(fact_counts, cohort_sizes, repeat, per_participant_budget, seed):
+    results = []
+    for n_facts in fact_counts:
+        for n_participants in cohort_sizes:
+            start = time.perf_counter()
+            mdp = SyntheticDomain(n_facts, 2 * n_facts, n_participants, seed=seed)
+            info = {'domain': 'SyntheticDomain', 'n_facts': n_facts + 1,
+                    'n_states': len(mdp.get_state_space()), 'n_actions': len(mdp.get_actions())}
+            results.append(dict(info, benchmark='build_domain', cohort_size=n_participants,
+                                seconds=time.perf_counter() - start))
+            target_trajectory = mdp.get_random_trajectory(3, seed=seed)
+            for result in bench_solvers(mdp, target_trajectory, n_participants, repeat, per_participant_budget):
+                results.append(dict(info, **result))
+    return results
+
+
+def run_scenario_benchmark(repeat):
+    from MDP_Scenario1 import MDP_Scenario1
+    mdp = MDP_Scenario1()
+    mdp.read_rewards_excel_all_lines(SCENARIO_SURVEY_FILE)
+    rewards_matrix = [rewards for rewards in mdp.get_rewards_matrix_all() if rewards != "None"][0]
+    return [{'benchmark': 'value_iteration', 'domain': 'MDP_Scenario1', 'cohort_size': 1,
+             'n_states': len(mdp.get_state_space()),
+             'seconds': time_call(lambda: mdp.value_iteration(rewards_matrix), repeat)}]
+
+
+def compare_results(results, baseline_file, tolerance):
+    # benchmarks that got slower than tolerance x their baseline time
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    def key(result):
+        return (result['benchmark'], result.get('domain'), result.get('n_facts'), result.get('cohort_size'))
+    baseline_seconds = {key(result): result['seconds'] for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline_seconds.get(key(result))
+        if previous is not None and result['seconds'] > tolerance * previous:
+            regressions.append((key(result), previous, result['seconds']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the MDP pipeline on the survey domains and synthetic scale-ups.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON report to write')
+    parser.add_argument('--cohort-sizes', type=int, nargs='+', default=[1, 100, 10000])
+    parser.add_argument('--fact-counts', type=int, nargs='+', default=[4, 8, 12],
+                        help='fact counts of the synthetic domains, each with twice as many actions')
+    parser.add_argument('--synthetic-cohort-sizes', type=int, nargs='+', default=[1, 100])
+    parser.add_argument('--per-participant-budget', type=int, default=60000,
+                        help='largest participants x states the per-participant solver is timed on')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-scenario', action='store_true', help='skip MDP_Scenario1')
+    parser.add_argument('--compare', help='earlier report to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='slowdown factor over --compare that counts as a regression')
+    args = parser.parse_args()
+
+    results = run_ingestion_benchmarks(args.repeat)
+    results += run_domain_benchmarks(args.cohort_sizes, args.repeat, args.per_participant_budget, args.seed)
+    results += run_scaling_benchmarks(args.fact_counts, args.synthetic_cohort_sizes, args.repeat,
+                                      args.per_participant_budget, args.seed)
+    if not args.skip_scenario:
+        results += run_scenario_benchmark(1)
+
+    report = {
+        'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                 'repeat': args.repeat},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    for result in results:
+        print(result['benchmark'], result.get('domain'), 'facts:', result.get('n_facts'),
+              'cohort:', result.get('cohort_size'), 'seconds:', round(result['seconds'], 6))
+    print("Report written to", args.output)
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.tolerance)
+        for benchmark_key, previous, seconds in regressions:
+            print("REGRESSION", benchmark_key, previous, "->", seconds)
+        if regressions:
+            sys.exit(1)
@@ -1,19 +1,25 @@
-from MDP import MDP
-import pandas as pd
-from Utils import powerset, value_iteration, get_policy, test_specification, rollout_policy
+from MDP import MDP, ActionSchema
+import numpy as np
+from survey import get_domain_rewards
+from Utils import cached_batch_solve, get_policy, test_specification, rollout_policy
 
 class Navigation(MDP):
     def __init__(self, rewards_matrix_file, discount=0.99):
         self.discount = discount
         self.get_all_facts()
         self.rewards_matrix_file = rewards_matrix_file
-        self.state_space = self.generate_state_space()
-        self.actions = self.generate_actions()
+        self.action_schema = self.generate_action_schema()
+        self.actions = list(self.action_schema)
         self.init_state = self.generate_init_state()
-        self.read_rewards_excel_all_lines()
-        self.V = []
-        self.Q = []
-        self.Policy = []
+        self.state_space = self.generate_state_space()
+        self.compile_transition_model()
+        if rewards_matrix_file is None:
+            # the model alone, participants are fed in from elsewhere (see pipeline.py)
+            self.init_solution_store()
+        else:
+            self.read_rewards_excel_all_lines()
+            # array-backed V / Q / Policy for the whole cohort, see results.py
+            self.init_solution_store(capacity=len(self.all_reward_matrices))
 
     def get_all_facts(self):
         # Facts are 1. The door is closed
@@ -26,116 +32,60 @@ class Navigation(MDP):
         self.fact_set = set(self.fact_list)
 
     def generate_state_space(self):
-        state_space = powerset(self.fact_set)
-        return list(state_space)
+        # only the states reachable from init_state, generate_bitmask_state_space() gives all of them
+        return self.generate_reachable_state_space()
 
-    def generate_actions(self):
+    def generate_action_schema(self):
         # 1. Open the door
         # 2. Move to the room
         # 3. Pick up the suitcase outside the room
         # 4. Dropoff the suitcase inside the room
         # 5. Exit the task.
-        # return ['Open the door', 'Pick up the suitcase outside the room', 'Move to the room', 'Dropoff the suitcase inside the room', 'Exit the task']
-        return ['Open the door', 'Pick up the suitcase outside the room', 'Dropoff the suitcase inside the room', 'Exit the task']
+        # an action whose preconditions are not met ends the task, like 'Exit the task' always does
+        return {
+            'Open the door': ActionSchema(
+                preconditions=['The door is closed', 'The robot is holding the suitcase'],
+                delete_list=['The door is closed'], add_list=['The door is open']),
+            'Pick up the suitcase outside the room': ActionSchema(
+                preconditions=['The robot is not holding the suitcase', 'The suitcase is outside the room'],
+                delete_list=['The robot is not holding the suitcase'], add_list=['The robot is holding the suitcase']),
+            # 'Move to the room': ActionSchema(
+            #     preconditions=['The door is open', 'The robot is holding the suitcase', 'The suitcase is outside the room.'],
+            #     delete_list=['The suitcase is outside the room.'], add_list=['The suitcase is inside the room']),
+            'Dropoff the suitcase inside the room': ActionSchema(
+                preconditions=['The door is open', 'The robot is holding the suitcase', 'The suitcase is inside the room'],
+                delete_list=['The robot is holding the suitcase'], add_list=['The robot is not holding the suitcase']),
+            'Exit the task': ActionSchema(add_list=['task_complete']),
+        }
 
     def generate_init_state(self):
         return set(['The door is closed', 'The robot is not holding the suitcase', 'The suitcase is outside the room'])
 
-    def get_transition_probability(self, state, action, next_state):
-        if 'task_complete' in state:
-            if state == next_state:
-                return 1
-            else:
-                return 0
-        if action == 'Open the door':
-            if 'The door is closed' in state and 'The robot is holding the suitcase' in state:
-                expected_next_state = (state - set(['The door is closed']))| set(['The door is open'])
-                if expected_next_state == next_state:
-                    return 1
-            # If precondition are not met the task should exit
-            else:
-                expected_next_state = state | set(['task_complete'])
-                if expected_next_state == next_state:
-                    return 1
-        elif action == 'Pick up the suitcase outside the room':
-            if 'The robot is not holding the suitcase' in state and 'The suitcase is outside the room' in state:
-                expected_next_state = (state - set(['The robot is not holding the suitcase']))| set(['The robot is holding the suitcase'])
-                if expected_next_state == next_state:
-                    return 1
-            # If precondition are not met the task should exit
-            else:
-                expected_next_state = state | set(['task_complete'])
-                if expected_next_state == next_state:
-                    return 1
-        # elif action == 'Move to the room':
-        #     if 'The door is open' in state and 'The robot is holding the suitcase' in state and 'The suitcase is outside the room.' in state:
-        #         expected_next_state = (state - set(['The suitcase is outside the room.']))| set(['The suitcase is inside the room'])
-        #         if expected_next_state == next_state:
-        #             return 1
-        #     # If precondition are not met the task should exit
-        #     else:
-        #         expected_next_state = state | set(['task_complete'])
-        #         if expected_next_state == next_state:
-        #             return 1
-        elif action == 'Dropoff the suitcase inside the room':
-            if 'The door is open' in state and 'The robot is holding the suitcase' in state and 'The suitcase is inside the room' in state:
-                expected_next_state = (state - set(['The robot is holding the suitcase']))| set(['The robot is not holding the suitcase'])
-                if expected_next_state == next_state:
-                    return 1
-            # If precondition
-            else:
-                expected_next_state = state | set(['task_complete'])
-                if expected_next_state == next_state:
-                    return 1
-        elif action == 'Exit the task':
-            expected_next_state = state | set(['task_complete'])
-            if next_state == expected_next_state:
-                return 1
-        return 0
-
-    def get_reward(self, state, action, participant_id=0):
-        if 'task_complete' in state:
-            return 0
-        total_reward = 0
-        for fact in self.all_reward_matrices[participant_id][action]:
-            if fact in state:
-                total_reward += self.all_reward_matrices[participant_id][action][fact]
-        return total_reward
-
     def read_rewards_excel_all_lines(self):
-        # read by default 1st sheet of an excel file
-        df = pd.read_excel(self.rewards_matrix_file)
-        # print(df)
-        # print(df.shape)
-        self.all_reward_matrices = []
-        self.number_of_participants = df.shape[0]
-        for row_id in range(1, df.shape[0]):
-            # print(df.iloc[row_id, 212:240])
-            # for col_id in range(212, 240):
-            #     print("row_id: ", row_id, "column_id: ", col_id, "value: ", df.iloc[row_id, col_id])
-            # all_rewards = df.iloc[row_id, 89:119].tolist()
-            all_rewards = df.iloc[row_id, 83:107].tolist()
-            action_list = self.get_actions()
-            fact_list = self.fact_list
-            rewards_matrix = {act: {fact: 0 for fact in fact_list} for act in action_list}
-            idx = 0
-            for fact in fact_list:
-                for act in action_list:
-                    if fact != 'task_complete':
-                        rewards_matrix[act][fact] = int(all_rewards[idx])
-                        idx = idx + 1
-            self.all_reward_matrices.append(rewards_matrix)
+        # the reward columns of every response as one numeric array; the workbook is parsed
+        # once for all domains and cached on disk, see survey.py
+        all_rewards = get_domain_rewards(self.rewards_matrix_file, 'Navigation')
+        if np.isnan(all_rewards).any():
+            raise ValueError("Non-numeric reward entries in " + self.rewards_matrix_file)
+        # rows of the sheet, including the row with the question texts
+        self.number_of_participants = all_rewards.shape[0] + 1
+        # dense (participants x actions x facts) weights, see MDP.set_reward_weights
+        self.set_reward_weights(all_rewards.astype(int))
+
 
 if __name__ == '__main__':
     # mdp = Navigation('4.0 Prolific - Goals vs Rewards - Specify Objective_February 7, 2025_13.32.xlsx')
     mdp = Navigation('5.0 Prolific - Goals vs Rewards - Specify Objective_February 9, 2025_19.10.xlsx')
     # ['Open the door', 'Pick up the suitcase outside the room', 'Move to the room', 'Dropoff the suitcase inside the room', 'Exit the task']
     target_trajectory = ['Pick up the suitcase outside the room', 'Open the door', 'Dropoff the suitcase inside the room', 'Exit the task']
+    # every participant shares the transition model, so the whole cohort is solved in one batch;
+    # the reachable graph is acyclic, so a single backward-induction pass is exact, and
+    # participants who entered the same reward matrix are only solved once
+    cached_batch_solve(mdp, mdp.get_reward_tensor(), solver='backward_induction')
     for participant_id in range(len(mdp.all_reward_matrices)):
-        value_iteration(mdp, participant_id=participant_id)
         print("Participant ID: ", participant_id)
         correct_flag, underspecified_flag = test_specification(mdp, target_trajectory, participant_id=participant_id)
-        policy = get_policy(mdp)
+        policy = get_policy(mdp, participant_id=participant_id)
         policy_rollout = rollout_policy(mdp, policy, participant_id=participant_id)
         print("Policy Rollout: ", policy_rollout)
         if correct_flag:
@@ -0,0 +1,170 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from MDP import TransitionModel
+from Utils import BATCH_SOLVERS, get_greedy_actions, solve_cohort, store_batch_solution, test_specification
+
+# models rebuilt inside a worker process, keyed by the shared-memory names of their arrays,
+# so a worker that gets several chunks of the same cohort only attaches to them once
+_worker_models = {}
+
+
+class SharedArray(object):
+    # A numpy array copied into a shared-memory block. Only the (name, shape, dtype)
+    # descriptor is pickled to the worker processes, which map the same block.
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf)
+        self.array[...] = array
+        self.descriptor = (self.shm.name, array.shape, array.dtype.str)
+
+    def release(self):
+        # numpy views of the buffer have to be gone before the block can be closed
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_shared_array(descriptor):
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _get_worker_model(model_descriptor):
+    n_states, actions, array_descriptors = model_descriptor
+    key = tuple(descriptor[0] for descriptor in array_descriptors)
+    if key not in _worker_models:
+        # the shared-memory handles stay open for the lifetime of the worker
+        handles_and_arrays = [attach_shared_array(descriptor) for descriptor in array_descriptors]
+        indptr, indices, probs = [array for _, array in handles_and_arrays]
+        model = TransitionModel(n_states, actions, indptr, indices, probs)
+        _worker_models[key] = (model, [shm for shm, _ in handles_and_arrays])
+    return _worker_models[key][0]
+
+
+def _solve_chunk(task):
+    # solves participants [start, stop) of one cohort and writes V and Q straight
+    # into the shared output arrays, so nothing but the row count is sent back
+    model_descriptor, rewards_descriptor, V_descriptor, Q_descriptor, start, stop, discount, epsilon, solver = task
+    model = _get_worker_model(model_descriptor)
+    handles = []
+    try:
+        shm, rewards = attach_shared_array(rewards_descriptor)
+        handles.append(shm)
+        shm, V_out = attach_shared_array(V_descriptor)
+        handles.append(shm)
+        shm, Q_out = attach_shared_array(Q_descriptor)
+        handles.append(shm)
+        V, Q = BATCH_SOLVERS[solver](model, rewards[start:stop], discount, epsilon)
+        V_out[start:stop] = V
+        Q_out[start:stop] = Q
+        del rewards, V_out, Q_out
+    finally:
+        for shm in handles:
+            shm.close()
+    return stop - start
+
+
+def parallel_batch_solve(cohorts, solver='backward_induction', epsilon=0.001, max_workers=None, chunk_size=None):
+    # Solves several cohorts, e.g. one per domain and survey file, on a process pool.
+    # cohorts is a list of (mdp, rewards) pairs where rewards is the (participants x states
+    # x actions) tensor of that mdp. The compiled transition models and the reward tensors
+    # are placed in shared memory once and every worker solves chunks of participants.
+    # Returns [(V, Q, policy), ...] in cohort order with participants in their original
+    # order; like the batch solvers, the rows are also appended to mdp.V / mdp.Q.
+    if solver not in BATCH_SOLVERS:
+        raise ValueError("Unknown batch solver: " + str(solver))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    total_participants = sum(len(rewards) for _, rewards in cohorts)
+    if chunk_size is None:
+        # a few chunks per worker keeps the pool balanced when cohorts differ in size
+        chunk_size = max(1, math.ceil(total_participants / (max_workers * 4)))
+
+    shared = []
+    try:
+        tasks = []
+        outputs = []
+        for mdp, rewards in cohorts:
+            model = mdp.transition_model
+            rewards = np.asarray(rewards, dtype=np.float64)
+            model_arrays = [SharedArray(model.indptr), SharedArray(model.indices), SharedArray(model.probs)]
+            shared_rewards = SharedArray(rewards)
+            V_out = SharedArray(np.zeros(rewards.shape[:2]))
+            Q_out = SharedArray(np.zeros(rewards.shape))
+            shared.extend(model_arrays + [shared_rewards, V_out, Q_out])
+            outputs.append((V_out, Q_out))
+            model_descriptor = (model.n_states, model.actions, [array.descriptor for array in model_arrays])
+            for start in range(0, len(rewards), chunk_size):
+                stop = min(start + chunk_size, len(rewards))
+                tasks.append((model_descriptor, shared_rewards.descriptor, V_out.descriptor, Q_out.descriptor,
+                              start, stop, mdp.discount, epsilon, solver))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(_solve_chunk, tasks):
+                pass
+
+        results = []
+        for (mdp, _), (V_out, Q_out) in zip(cohorts, outputs):
+            V = V_out.array.copy()
+            Q = Q_out.array.copy()
+            store_batch_solution(mdp, V, Q)
+            results.append((V, Q, get_greedy_actions(Q)))
+        return results
+    finally:
+        for array in shared:
+            array.release()
+
+
+def threaded_solve_cohort(model, rewards, solver='backward_induction', epsilon=0.001, max_workers=None,
+                          chunk_size=None, stats=None, stopping='residual'):
+    # solve_cohort on a thread pool: every thread solves a chunk of participants on the same
+    # read-only CompiledMDP, and the NumPy kernels release the GIL for the array work. No
+    # shared memory or pickling is involved, which makes it the cheaper choice for
+    # one cohort; returns a SolveResult per participant, in order. stopping is given as rule
+    # names, every chunk checks them with its own StoppingRules.
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    rewards = np.asarray(rewards, dtype=np.float64)
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(len(rewards) / (max_workers * 4)))
+    starts = range(0, len(rewards), chunk_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunks = executor.map(lambda start: solve_cohort(model, rewards[start:start + chunk_size], solver, epsilon,
+                                                         participant_ids=range(start, min(start + chunk_size,
+                                                                                          len(rewards))),
+                                                         stats=stats, stopping=stopping), starts)
+        return [result for chunk in chunks for result in chunk]
+
+
+if __name__ == '__main__':
+    from navigation import Navigation
+    from self_driving import SelfDriving
+    from block_stacking import BlockStacking
+
+    file_title = '5.0 Prolific - Goals vs Rewards - Specify Objective_February 9, 2025_19.10.xlsx'
+    domains = [
+        (Navigation(file_title), ['Pick up the suitcase outside the room', 'Open the door', 'Dropoff the suitcase inside the room', 'Exit the task']),
+        (SelfDriving(file_title), ['Pick up the passenger from the initial position', 'Drop off the passenger at the drop-off location', 'Go to the battery charging station', 'Exit the task']),
+        (BlockStacking(file_title), ['Swap A and B', 'Stack B on A', 'Exit the task']),
+    ]
+    start_time = time.time()
+    parallel_batch_solve([(mdp, mdp.get_reward_tensor()) for mdp, _ in domains])
+    print("Solved in ", time.time() - start_time, " seconds")
+    start_time = time.time()
+    for mdp, _ in domains:
+        model = mdp.get_compiled_model()
+        threaded_solve_cohort(model, model.get_reward_tensor(mdp.reward_weights))
+    print("Solved on threads in ", time.time() - start_time, " seconds")
+    for mdp, target_trajectory in domains:
+        print(type(mdp).__name__)
+        for participant_id in range(len(mdp.all_reward_matrices)):
+            correct_flag, underspecified_flag = test_specification(mdp, target_trajectory, participant_id=participant_id)
+            print("Participant ID: ", participant_id, "Correct: ", correct_flag, "Underspecified: ", underspecified_flag)
@@ -0,0 +1,301 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+import numpy as np
+import openpyxl
+
+from survey import get_reward_columns
+from navigation import Navigation
+from self_driving import SelfDriving
+from block_stacking import BlockStacking
+from results import SolutionDatabase, get_solution_key, get_target_key
+from Utils import BATCH_SOLVERS, STOPPING_RULES, get_greedy_actions, get_reward_fingerprint, get_solver_key, \
+    test_specification, rollout_policy
+
+# domain name -> (class, target trajectory)
+DOMAINS = {
+    'Navigation': (Navigation, ['Pick up the suitcase outside the room', 'Open the door', 'Dropoff the suitcase inside the room', 'Exit the task']),
+    'SelfDriving': (SelfDriving, ['Pick up the passenger from the initial position', 'Drop off the passenger at the drop-off location', 'Go to the battery charging station', 'Exit the task']),
+    'BlockStacking': (BlockStacking, ['Swap A and B', 'Stack B on A', 'Exit the task']),
+}
+
+# columns of the CSV output, in order
+CSV_FIELDS = ['survey', 'domain', 'participant_id', 'status', 'correct', 'underspecified', 'rollout']
+
+
+def _to_number(value):
+    # same coercion as survey.py: numbers pass, numeric strings are parsed, the rest is NaN
+    if isinstance(value, bool) or value is None:
+        return float('nan')
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def iter_survey_rows(file_title, domain_name):
+    # Streams the reward columns of one domain from the workbook, one float array per response
+    # in sheet order. The sheet is read row by row in openpyxl's read-only mode, so memory
+    # does not grow with the number of responses. Row 1 is the header and row 2 holds the
+    # question texts, the responses start at row 3. Rows come out exactly like
+    # survey.load_survey_rewards gives them to the domain classes, so participant ids match:
+    # empty rows inside the sheet are NaN (status invalid) and only the empty rows at its end
+    # are dropped. A workbook without the domain's reward columns raises the same ValueError
+    # as survey.get_domain_rewards, before any row is read.
+    workbook = openpyxl.load_workbook(file_title, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        header = next(sheet.iter_rows(max_row=1, values_only=True), ())
+        n_columns = max([i + 1 for i, value in enumerate(header) if value is not None], default=0)
+        first, last = get_reward_columns(file_title, domain_name, n_columns)
+    except Exception:
+        workbook.close()
+        raise
+    return _iter_sheet_rows(workbook, sheet, first, last)
+
+
+def _iter_sheet_rows(workbook, sheet, first, last):
+    try:
+        blank_rows = 0
+        for row in sheet.iter_rows(min_row=3, values_only=True):
+            if all(value is None for value in row):
+                blank_rows += 1
+                continue
+            for _ in range(blank_rows):
+                yield np.full(last - first, np.nan)
+            blank_rows = 0
+            values = [_to_number(value) for value in row[first:last]]
+            yield np.array(values + [float('nan')] * (last - first - len(values)), dtype=np.float64)
+    finally:
+        workbook.close()
+
+
+def classify_specification(correct_flag, underspecified_flag):
+    if not correct_flag:
+        return 'misspecified'
+    if underspecified_flag:
+        return 'underspecified'
+    return 'correct'
+
+
+def iter_participant_results(mdp, target_trajectory, rows, solver='backward_induction', epsilon=0.001,
+                             chunk_size=256, tolerance=1e-9, database=None, stopping='residual'):
+    # Solves and classifies a stream of survey rows, yielding one dict per participant in input
+    # order. Rows are taken chunk_size at a time and solved with a BATCH_SOLVERS kernel on the
+    # compiled model of mdp; nothing is stored on mdp, so memory is bounded by one chunk.
+    # Rows with non-numeric entries are reported with status 'invalid' instead of stopping the run.
+    # With a SolutionDatabase, participants solved by an earlier run are read back from it.
+    # stopping is passed to the kernel, as rule names (see Utils.StoppingRules).
+    if solver not in BATCH_SOLVERS:
+        raise ValueError("Unknown batch solver: " + str(solver))
+    state_hashes = [mdp.get_state_hash(s) for s in mdp.get_state_space()]
+    actions = mdp.get_actions()
+    domain = type(mdp).__name__
+    participant_id = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            for result in _solve_chunk(mdp, target_trajectory, chunk, participant_id, solver, epsilon,
+                                       tolerance, state_hashes, actions, domain, database, stopping):
+                yield result
+            participant_id += len(chunk)
+            chunk = []
+    for result in _solve_chunk(mdp, target_trajectory, chunk, participant_id, solver, epsilon,
+                               tolerance, state_hashes, actions, domain, database, stopping):
+        yield result
+
+
+def _solve_chunk(mdp, target_trajectory, chunk, first_participant_id, solver, epsilon, tolerance,
+                 state_hashes, actions, domain, database, stopping):
+    if not chunk:
+        return
+    valid = [i for i, row in enumerate(chunk) if not np.isnan(row).any()]
+    if valid:
+        weights = mdp.get_reward_weights(np.array([chunk[i] for i in valid]).astype(int))
+        Q, greedy, keys, verdicts = _solve_rewards(mdp, mdp.compute_reward_tensor(weights), solver, epsilon,
+                                                   target_trajectory, database, stopping)
+    solved = {i: k for k, i in enumerate(valid)}
+    new_verdicts = []
+    for i in range(len(chunk)):
+        result = {'domain': domain, 'participant_id': first_participant_id + i}
+        if i not in solved:
+            result['status'] = 'invalid'
+            yield result
+            continue
+        k = solved[i]
+        if verdicts[k] is None:
+            verdicts[k] = test_specification(mdp, target_trajectory, tolerance=tolerance, Q=Q[k])
+            new_verdicts.append((keys[k], target_trajectory, verdicts[k]))
+        correct_flag, underspecified_flag = verdicts[k]
+        policy = {s_hash: actions[a_idx] for s_hash, a_idx in zip(state_hashes, greedy[k].tolist())}
+        policy['Terminate'] = "None"
+        result['status'] = classify_specification(correct_flag, underspecified_flag)
+        result['correct'] = correct_flag
+        result['underspecified'] = underspecified_flag
+        result['rollout'] = rollout_policy(mdp, policy)
+        yield result
+    if database is not None and new_verdicts:
+        database.set_verdicts(new_verdicts)
+
+
+def _solve_rewards(mdp, rewards, solver, epsilon, target_trajectory, database, stopping):
+    # Q, greedy actions, database keys and (correct, underspecified) verdicts of a
+    # (participants x states x actions) reward tensor. Participants already in the database are
+    # read back, with their verdict for target_trajectory if it was stored; the rest are solved
+    # and written to it. Without a database keys are None and verdicts are all None.
+    if database is None:
+        _, Q = BATCH_SOLVERS[solver](mdp.transition_model, rewards, mdp.discount, epsilon, stopping=stopping)
+        return Q, get_greedy_actions(Q), [None] * len(rewards), [None] * len(rewards)
+    domain_fingerprint = mdp.get_domain_fingerprint()
+    solver_key = get_solver_key(solver, stopping)
+    keys = [get_solution_key(domain_fingerprint, get_reward_fingerprint(row), mdp.discount, epsilon, solver_key)
+            for row in rewards]
+    stored = database.get_many(keys)
+    missing = [k for k, key in enumerate(keys) if key not in stored]
+    Q = np.zeros(rewards.shape)
+    greedy = np.zeros(rewards.shape[:2], dtype=np.int64)
+    verdicts = [None] * len(rewards)
+    target_key = get_target_key(target_trajectory)
+    for k, key in enumerate(keys):
+        if key in stored:
+            _, Q[k], greedy[k], stored_verdicts = stored[key]
+            if target_key in stored_verdicts:
+                verdicts[k] = tuple(stored_verdicts[target_key])
+    if missing:
+        V_missing, Q_missing = BATCH_SOLVERS[solver](mdp.transition_model, rewards[missing], mdp.discount, epsilon,
+                                                     stopping=stopping)
+        Q[missing] = Q_missing
+        greedy[missing] = get_greedy_actions(Q_missing)
+        # participants with the same rewards in this chunk are written once
+        entries = {}
+        for row_idx, k in enumerate(missing):
+            entries[keys[k]] = (keys[k], V_missing[row_idx], Q_missing[row_idx], greedy[k])
+        database.put_many(list(entries.values()))
+    return Q, greedy, keys, verdicts
+
+
+def write_jsonl(results, f):
+    # one JSON object per line, flushed as soon as it is written so a running job's output
+    # can already be read
+    count = 0
+    for result in results:
+        f.write(json.dumps(result) + '\n')
+        f.flush()
+        count += 1
+    return count
+
+
+def write_csv(results, f):
+    # the same records as CSV rows, the rollout joined with ' > '
+    writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    count = 0
+    for result in results:
+        row = dict(result)
+        if 'rollout' in row:
+            row['rollout'] = ' > '.join(row['rollout'])
+        writer.writerow(row)
+        f.flush()
+        count += 1
+    return count
+
+
+WRITERS = {'jsonl': write_jsonl, 'csv': write_csv}
+
+
+def load_targets(config_file):
+    # JSON config of target trajectories, {"Navigation": ["Pick up ...", ...], ...}; domains it
+    # leaves out keep the trajectories in DOMAINS
+    targets = {domain_name: target_trajectory for domain_name, (_, target_trajectory) in DOMAINS.items()}
+    if config_file is not None:
+        with open(config_file) as f:
+            config = json.load(f)
+        for domain_name, target_trajectory in config.items():
+            if domain_name not in DOMAINS:
+                raise ValueError("Unknown domain in " + config_file + ": " + domain_name)
+            targets[domain_name] = list(target_trajectory)
+    return targets
+
+
+def iter_survey_results(file_title, domain_name, target_trajectory, solver='backward_induction', epsilon=0.001,
+                        chunk_size=256, database_file=None, database_max_bytes=1 << 30, stopping='residual'):
+    # every participant of one domain in one workbook, tagged with the workbook name;
+    # database_file is an optional SQLite SolutionDatabase shared by all runs
+    domain_class, _ = DOMAINS[domain_name]
+    mdp = domain_class(None)
+    rows = iter_survey_rows(file_title, domain_name)
+    database = None if database_file is None else SolutionDatabase(database_file, max_bytes=database_max_bytes)
+    try:
+        for result in iter_participant_results(mdp, target_trajectory, rows, solver=solver, epsilon=epsilon,
+                                               chunk_size=chunk_size, database=database, stopping=stopping):
+            result['survey'] = os.path.basename(file_title)
+            yield result
+    finally:
+        if database is not None:
+            database.close()
+
+
+def _run_task(task):
+    # one (workbook, domain) pair in a worker process
+    return list(iter_survey_results(*task))
+
+
+def run_pipeline(file_titles, domain_names, output, solver='backward_induction', epsilon=0.001, chunk_size=256,
+                 targets=None, jobs=1, output_format='jsonl', database_file=None, database_max_bytes=1 << 30,
+                 stopping='residual'):
+    # Streams every (workbook, domain) pair into one consolidated JSONL or CSV file ('-' for
+    # stdout), in the order the pairs are listed. With jobs > 1 the pairs are solved on a
+    # process pool; records are still written in order, each pair as soon as it and all the
+    # pairs before it are done. database_file keeps every solution and verdict in an SQLite
+    # SolutionDatabase, so re-runs only solve participants it has not seen; solutions are keyed
+    # by the stopping rules too. Returns the number of records written.
+    if targets is None:
+        targets = load_targets(None)
+    tasks = [(file_title, domain_name, targets[domain_name], solver, epsilon, chunk_size, database_file,
+              database_max_bytes, stopping)
+             for file_title in file_titles for domain_name in domain_names]
+    write = WRITERS[output_format]
+    f = sys.stdout if output == '-' else open(output, 'w', newline='')
+    try:
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                return write(chain.from_iterable(executor.map(_run_task, tasks)), f)
+        return write(chain.from_iterable(iter_survey_results(*task) for task in tasks), f)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solve and classify every response of one or more survey workbooks, '
+                                                 'one record per participant.')
+    parser.add_argument('surveys', nargs='+', help='Qualtrics exports (.xlsx)')
+    parser.add_argument('--domains', nargs='+', default=list(DOMAINS), choices=list(DOMAINS))
+    parser.add_argument('--config', help='JSON file mapping domain names to target trajectories')
+    parser.add_argument('--output', default='-', help="file to write, '-' for stdout")
+    parser.add_argument('--format', choices=list(WRITERS),
+                        help='output format, by default taken from the --output extension (jsonl otherwise)')
+    parser.add_argument('--solver', default='backward_induction', choices=list(BATCH_SOLVERS))
+    parser.add_argument('--stopping', nargs='+', default=['residual'], choices=list(STOPPING_RULES),
+                        help='stopping rules of value iteration, the first one that holds stops a participant')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes, one (survey, domain) pair each')
+    parser.add_argument('--chunk-size', type=int, default=256, help='participants solved per batch')
+    parser.add_argument('--store', help='SQLite solution store to reuse across runs, e.g. results/solutions.sqlite')
+    parser.add_argument('--store-max-mb', type=float, default=1024,
+                        help='size cap of the store, least recently used solutions are evicted beyond it')
+    args = parser.parse_args()
+    output_format = args.format
+    if output_format is None:
+        output_format = 'csv' if args.output.endswith('.csv') else 'jsonl'
+    run_pipeline(args.surveys, args.domains, args.output, solver=args.solver, chunk_size=args.chunk_size,
+                 targets=load_targets(args.config), jobs=args.jobs, output_format=output_format,
+                 database_file=args.store, database_max_bytes=int(args.store_max_mb * (1 << 20)),
+                 stopping=tuple(args.stopping))
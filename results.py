@@ -0,0 +1,406 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class CohortSolution(object):
+    # Contiguous storage for the solutions of a whole cohort:
+    #   V      - (participants x states) float array
+    #   Q      - (participants x states x actions) float array
+    #   Policy - (participants x states) int8 action indices, -1 where there is no action
+    # mdp.V, mdp.Q and mdp.Policy are list-like views over these arrays, so code that appends
+    # dicts or reads mdp.Q[participant_id][s_hash][a] keeps working. Rows are added at the
+    # end and the arrays grow geometrically; with mmap_dir they are memory-mapped .npy files
+    # instead of RAM, and spill() moves an in-memory store to disk.
+    def __init__(self, state_hashes, actions, capacity=16, dtype=np.float64, mmap_dir=None):
+        self.state_hashes = list(state_hashes)
+        self.state_index = {s_hash: s_idx for s_idx, s_hash in enumerate(self.state_hashes)}
+        self.actions = list(actions)
+        self.action_index = {a: a_idx for a_idx, a in enumerate(self.actions)}
+        self.dtype = np.dtype(dtype)
+        self.policy_dtype = np.int8 if len(self.actions) <= np.iinfo(np.int8).max else np.int16
+        self.mmap_dir = mmap_dir
+        # stores sharing an mmap_dir (e.g. the domains of one run) each get their own files
+        self.file_prefix = uuid.uuid4().hex
+        self.capacity = 0
+        self.arrays = {}
+        self.lengths = {'V': 0, 'Q': 0, 'Policy': 0}
+        self._allocate(max(capacity, 1))
+        self.V = ValueTable(self)
+        self.Q = QTable(self)
+        self.Policy = PolicyTable(self)
+
+    def _get_shape(self, name, capacity):
+        if name == 'Q':
+            return (capacity, len(self.state_hashes), len(self.actions))
+        return (capacity, len(self.state_hashes))
+
+    def _allocate(self, capacity):
+        # (re)creates the three arrays with room for capacity participants, keeping the rows so far
+        old_arrays = self.arrays
+        self.arrays = {}
+        for name, dtype in (('V', self.dtype), ('Q', self.dtype), ('Policy', self.policy_dtype)):
+            shape = self._get_shape(name, capacity)
+            if self.mmap_dir is None:
+                array = np.zeros(shape, dtype=dtype)
+            else:
+                os.makedirs(self.mmap_dir, exist_ok=True)
+                path = os.path.join(self.mmap_dir, self.file_prefix + '.' + name + '.' + str(capacity) + '.npy')
+                array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+            if name == 'Policy':
+                array[...] = -1
+            if name in old_arrays:
+                array[:self.lengths[name]] = old_arrays[name][:self.lengths[name]]
+            self.arrays[name] = array
+        old_paths = [array.filename for array in old_arrays.values() if isinstance(array, np.memmap)]
+        old_arrays.clear()
+        for path in old_paths:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        self.capacity = capacity
+
+    def spill(self, mmap_dir):
+        # moves the arrays into memory-mapped files under mmap_dir, nothing to do if they are there already
+        if self.mmap_dir is not None and os.path.abspath(self.mmap_dir) == os.path.abspath(mmap_dir):
+            return
+        self.mmap_dir = mmap_dir
+        self._allocate(self.capacity)
+
+    def append_rows(self, name, rows):
+        rows = np.asarray(rows)
+        start = self.lengths[name]
+        if start + len(rows) > self.capacity:
+            self._allocate(max(start + len(rows), 2 * self.capacity))
+        self.arrays[name][start:start + len(rows)] = rows
+        self.lengths[name] = start + len(rows)
+
+
+class SolutionTable(object):
+    # list-like access to one of the arrays of a CohortSolution, one entry per participant
+    name = None
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.lengths[self.name]
+
+    def __iter__(self):
+        for participant_id in range(len(self)):
+            yield self[participant_id]
+
+    def __getitem__(self, participant_id):
+        return self.get_row_view(self._check_index(participant_id))
+
+    def __setitem__(self, participant_id, row):
+        self.store.arrays[self.name][self._check_index(participant_id)] = self.encode_row(row)
+
+    def append(self, row):
+        self.store.append_rows(self.name, self.encode_row(row)[None])
+
+    def clear(self):
+        # forgets the stored rows, the arrays keep their capacity
+        self.store.lengths[self.name] = 0
+
+    def extend_array(self, rows):
+        # appends a whole (participants x ...) block at once
+        self.store.append_rows(self.name, rows)
+
+    def get_array(self):
+        # the filled rows as an array, without copying
+        return self.store.arrays[self.name][:len(self)]
+
+    def _check_index(self, participant_id):
+        if participant_id < 0:
+            participant_id += len(self)
+        if not 0 <= participant_id < len(self):
+            raise IndexError("No " + self.name + " stored for participant " + str(participant_id))
+        return participant_id
+
+    def encode_row(self, row):
+        raise NotImplementedError
+
+    def get_row_view(self, participant_id):
+        raise NotImplementedError
+
+
+class ValueTable(SolutionTable):
+    name = 'V'
+
+    def encode_row(self, row):
+        if isinstance(row, Mapping):
+            row = [row[s_hash] for s_hash in self.store.state_hashes]
+        return np.asarray(row, dtype=self.store.dtype)
+
+    def get_row_view(self, participant_id):
+        return ValueRow(self.store, participant_id)
+
+
+class QTable(SolutionTable):
+    name = 'Q'
+
+    def encode_row(self, row):
+        if isinstance(row, Mapping):
+            row = [[row[s_hash][a] for a in self.store.actions] for s_hash in self.store.state_hashes]
+        return np.asarray(row, dtype=self.store.dtype)
+
+    def get_row_view(self, participant_id):
+        return QRow(self.store, participant_id)
+
+
+class PolicyTable(SolutionTable):
+    name = 'Policy'
+
+    def encode_row(self, row):
+        if isinstance(row, Mapping):
+            row = [self.store.action_index.get(row.get(s_hash), -1) for s_hash in self.store.state_hashes]
+        return np.asarray(row, dtype=self.store.policy_dtype)
+
+    def get_row_view(self, participant_id):
+        return PolicyRow(self.store, participant_id)
+
+
+class ValueRow(Mapping):
+    # {s_hash: V} of one participant
+    def __init__(self, store, participant_id):
+        self.store = store
+        self.participant_id = participant_id
+
+    def __getitem__(self, s_hash):
+        return float(self.store.arrays['V'][self.participant_id, self.store.state_index[s_hash]])
+
+    def __setitem__(self, s_hash, value):
+        self.store.arrays['V'][self.participant_id, self.store.state_index[s_hash]] = value
+
+    def __iter__(self):
+        return iter(self.store.state_hashes)
+
+    def __len__(self):
+        return len(self.store.state_hashes)
+
+
+class QRow(Mapping):
+    # {s_hash: {action: Q}} of one participant
+    def __init__(self, store, participant_id):
+        self.store = store
+        self.participant_id = participant_id
+
+    def __getitem__(self, s_hash):
+        return ActionValues(self.store, self.participant_id, self.store.state_index[s_hash])
+
+    def __iter__(self):
+        return iter(self.store.state_hashes)
+
+    def __len__(self):
+        return len(self.store.state_hashes)
+
+
+class ActionValues(Mapping):
+    # {action: Q} of one participant in one state
+    def __init__(self, store, participant_id, s_idx):
+        self.store = store
+        self.participant_id = participant_id
+        self.s_idx = s_idx
+
+    def __getitem__(self, action):
+        return float(self.store.arrays['Q'][self.participant_id, self.s_idx, self.store.action_index[action]])
+
+    def __setitem__(self, action, value):
+        self.store.arrays['Q'][self.participant_id, self.s_idx, self.store.action_index[action]] = value
+
+    def __iter__(self):
+        return iter(self.store.actions)
+
+    def __len__(self):
+        return len(self.store.actions)
+
+
+class PolicyRow(Mapping):
+    # {s_hash: action} of one participant, plus the 'Terminate' -> "None" entry get_policy adds
+    def __init__(self, store, participant_id):
+        self.store = store
+        self.participant_id = participant_id
+
+    def __getitem__(self, s_hash):
+        if s_hash == 'Terminate':
+            return "None"
+        a_idx = self.store.arrays['Policy'][self.participant_id, self.store.state_index[s_hash]]
+        return self.store.actions[a_idx] if a_idx >= 0 else None
+
+    def __setitem__(self, s_hash, action):
+        if s_hash == 'Terminate':
+            return
+        self.store.arrays['Policy'][self.participant_id, self.store.state_index[s_hash]] = \
+            self.store.action_index.get(action, -1)
+
+    def __iter__(self):
+        return iter(self.store.state_hashes + ['Terminate'])
+
+    def __len__(self):
+        return len(self.store.state_hashes) + 1
+
+
+class SolveResult(object):
+    # Standalone solution of one participant, returned by the solvers that run on a
+    # CompiledMDP instead of appending to mdp.V / mdp.Q:
+    #   V          - (states) array, Q - (states x actions) array, both read-only
+    #   policy     - (states) greedy action indices, ties go to the latest action
+    #   stopped_by - the stopping rule that ended the solve
+    #   eliminated - (states x actions) mask of provably suboptimal actions, or None
+    #   record     - the SolveRecord when the solve was instrumented, else None
+    # Rows follow the state order of the model it was solved on.
+    def __init__(self, model, V, Q, policy, participant_id=None, solver=None, stopped_by=None, eliminated=None,
+                 record=None):
+        self.state_hashes = model.state_hashes
+        self.actions = model.actions
+        self.V = np.asarray(V, dtype=np.float64)
+        self.Q = np.asarray(Q, dtype=np.float64)
+        self.policy = np.asarray(policy)
+        for array in (self.V, self.Q, self.policy, eliminated):
+            if array is not None:
+                array.flags.writeable = False
+        self.participant_id = participant_id
+        self.solver = solver
+        self.stopped_by = stopped_by
+        self.eliminated = eliminated
+        self.record = record
+
+    def get_values(self):
+        # {s_hash: V}
+        return dict(zip(self.state_hashes, self.V.tolist()))
+
+    def get_policy(self):
+        # {s_hash: greedy action}, the form rollout_policy takes
+        return {s_hash: self.actions[a_idx] for s_hash, a_idx in zip(self.state_hashes, self.policy.tolist())}
+
+
+class SolutionDatabase(object):
+    # Persistent per-participant solutions in an SQLite file, shared between runs and processes.
+    # A row is keyed by (domain fingerprint, reward fingerprint, discount, epsilon, solver), see
+    # get_solution_key, and holds V, Q, the greedy policy (action indices) and the specification
+    # verdicts computed from them, one per target trajectory. Once the stored arrays exceed
+    # max_bytes the least recently used rows are evicted.
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        # concurrent readers while a --jobs worker writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS solutions ('
+            ' domain TEXT, reward TEXT, discount REAL, epsilon REAL, solver TEXT,'
+            ' n_states INTEGER, n_actions INTEGER, V BLOB, Q BLOB, policy BLOB,'
+            ' verdicts TEXT, size INTEGER, last_used REAL,'
+            ' PRIMARY KEY (domain, reward, discount, epsilon, solver))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS solutions_last_used ON solutions (last_used)')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM solutions').fetchone()[0]
+
+    def get_size(self):
+        # bytes of stored arrays
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM solutions').fetchone()[0]
+
+    def get_many(self, keys):
+        # {key: (V, Q, policy, verdicts)} for the keys that are stored, marking them as used
+        found = {}
+        now = time.time()
+        with self.connection:
+            for key in set(keys):
+                row = self.connection.execute(
+                    'SELECT n_states, n_actions, V, Q, policy, verdicts FROM solutions'
+                    ' WHERE domain = ? AND reward = ? AND discount = ? AND epsilon = ? AND solver = ?',
+                    key).fetchone()
+                if row is None:
+                    continue
+                n_states, n_actions, V, Q, policy, verdicts = row
+                found[key] = (np.frombuffer(V, dtype=np.float64),
+                              np.frombuffer(Q, dtype=np.float64).reshape(n_states, n_actions),
+                              np.frombuffer(policy, dtype=np.int16), json.loads(verdicts))
+                self.connection.execute(
+                    'UPDATE solutions SET last_used = ? WHERE domain = ? AND reward = ? AND discount = ?'
+                    ' AND epsilon = ? AND solver = ?', (now,) + tuple(key))
+        return found
+
+    def put_many(self, entries):
+        # entries is [(key, V, Q, policy), ...]; verdicts of a replaced row are dropped
+        now = time.time()
+        with self.connection:
+            for key, V, Q, policy in entries:
+                V = np.ascontiguousarray(V, dtype=np.float64)
+                Q = np.ascontiguousarray(Q, dtype=np.float64)
+                policy = np.ascontiguousarray(policy, dtype=np.int16)
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO solutions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    tuple(key) + (Q.shape[0], Q.shape[1], V.tobytes(), Q.tobytes(), policy.tobytes(), '{}',
+                                  V.nbytes + Q.nbytes + policy.nbytes, now))
+        self.evict()
+
+    def set_verdicts(self, verdicts):
+        # verdicts is [(key, target_trajectory, (correct, underspecified)), ...] for stored keys
+        with self.connection:
+            for key, target_trajectory, verdict in verdicts:
+                row = self.connection.execute(
+                    'SELECT verdicts FROM solutions WHERE domain = ? AND reward = ? AND discount = ?'
+                    ' AND epsilon = ? AND solver = ?', key).fetchone()
+                if row is None:
+                    continue
+                stored = json.loads(row[0])
+                stored[get_target_key(target_trajectory)] = [bool(flag) for flag in verdict]
+                self.connection.execute(
+                    'UPDATE solutions SET verdicts = ? WHERE domain = ? AND reward = ? AND discount = ?'
+                    ' AND epsilon = ? AND solver = ?', (json.dumps(stored),) + tuple(key))
+
+    def evict(self):
+        # drops least recently used rows until the stored arrays fit in max_bytes
+        with self.connection:
+            excess = self.get_size() - self.max_bytes
+            while excess > 0:
+                row = self.connection.execute(
+                    'SELECT domain, reward, discount, epsilon, solver, size FROM solutions'
+                    ' ORDER BY last_used LIMIT 1').fetchone()
+                if row is None:
+                    break
+                self.connection.execute(
+                    'DELETE FROM solutions WHERE domain = ? AND reward = ? AND discount = ? AND epsilon = ?'
+                    ' AND solver = ?', row[:5])
+                excess -= row[5]
+
+    def iter_verdicts(self, domain=None):
+        # (key, target_trajectory, (correct, underspecified)) of every stored verdict, e.g. for
+        # reports that should not re-solve anything
+        query = 'SELECT domain, reward, discount, epsilon, solver, verdicts FROM solutions'
+        rows = self.connection.execute(query) if domain is None else \
+            self.connection.execute(query + ' WHERE domain = ?', (domain,))
+        for row in rows:
+            for target_key, verdict in json.loads(row[5]).items():
+                yield tuple(row[:5]), json.loads(target_key), tuple(verdict)
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM solutions')
+
+
+def get_solution_key(domain_fingerprint, reward_fingerprint, discount, epsilon, solver):
+    return (domain_fingerprint, reward_fingerprint, float(discount), float(epsilon), solver)
+
+
+def get_target_key(target_trajectory):
+    return json.dumps(list(target_trajectory))
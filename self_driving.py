@@ -1,19 +1,25 @@
-from MDP import MDP
-import pandas as pd
-from Utils import powerset, value_iteration, get_policy, test_specification, rollout_policy
+from MDP import MDP, ActionSchema
+import numpy as np
+from survey import get_domain_rewards
+from Utils import cached_batch_solve, get_policy, test_specification, rollout_policy
 
 class SelfDriving(MDP):
     def __init__(self, rewards_matrix_file, discount=0.99):
         self.discount = discount
         self.get_all_facts()
         self.rewards_matrix_file = rewards_matrix_file
-        self.state_space = self.generate_state_space()
-        self.actions = self.generate_actions()
+        self.action_schema = self.generate_action_schema()
+        self.actions = list(self.action_schema)
         self.init_state = self.generate_init_state()
-        self.read_rewards_excel_all_lines()
-        self.V = []
-        self.Q = []
-        self.Policy = []
+        self.state_space = self.generate_state_space()
+        self.compile_transition_model()
+        if rewards_matrix_file is None:
+            # the model alone, participants are fed in from elsewhere (see pipeline.py)
+            self.init_solution_store()
+        else:
+            self.read_rewards_excel_all_lines()
+            # array-backed V / Q / Policy for the whole cohort, see results.py
+            self.init_solution_store(capacity=len(self.all_reward_matrices))
 
 
     def get_all_facts(self):
@@ -21,96 +27,38 @@ class SelfDriving(MDP):
         self.fact_set = set(self.fact_list)
 
     def generate_state_space(self):
-        state_space = powerset(self.fact_set)
-        return list(state_space)
+        # only the states reachable from init_state, generate_bitmask_state_space() gives all of them
+        return self.generate_reachable_state_space()
 
-    def generate_actions(self):
-        return ['Pick up the passenger from the initial position', 'Drop off the passenger at the drop-off location', 'Go to the battery charging station', 'Exit the task']
+    def generate_action_schema(self):
+        # an action whose preconditions are not met ends the task, like 'Exit the task' always does
+        return {
+            'Pick up the passenger from the initial position': ActionSchema(
+                preconditions=['The car is empty', 'The passenger is not at the drop-off location', 'The car battery is not full'],
+                delete_list=['The car is empty'], add_list=['The car has the passenger']),
+            'Drop off the passenger at the drop-off location': ActionSchema(
+                preconditions=['The car has the passenger', 'The passenger is not at the drop-off location', 'The car battery is not full'],
+                delete_list=['The car has the passenger', 'The passenger is not at the drop-off location'],
+                add_list=['The passenger is at the drop-off location']),
+            'Go to the battery charging station': ActionSchema(
+                preconditions=['The car battery is not full', 'The passenger is at the drop-off location'],
+                delete_list=['The car battery is not full'], add_list=['The car battery is full']),
+            'Exit the task': ActionSchema(add_list=['task_complete']),
+        }
 
     def generate_init_state(self):
         return set(['The car is empty', 'The passenger is not at the drop-off location', 'The car battery is not full'])
 
-    def get_transition_probability(self, state, action, next_state):
-        if 'task_complete' in state:
-            if state == next_state:
-                return 1
-            else:
-                return 0
-        if action == 'Pick up the passenger from the initial position':
-            if 'The car is empty' in state and 'The passenger is not at the drop-off location' in state and 'The car battery is not full' in state:
-                expected_next_state = (state - set(['The car is empty']))| set(['The car has the passenger'])
-                if expected_next_state == next_state:
-                    return 1
-            # If precondition are not met the task should exit
-            else:
-                expected_next_state = state | set(['task_complete'])
-                if expected_next_state == next_state:
-                    return 1
-        elif action == 'Drop off the passenger at the drop-off location':
-            if 'The car has the passenger' in state and 'The passenger is not at the drop-off location' in state and 'The car battery is not full' in state:
-                expected_next_state = (state - set(['The car has the passenger', 'The passenger is not at the drop-off location']))| set(['The passenger is at the drop-off location'])
-                if expected_next_state == next_state:
-                    return 1
-            # If precondition are not met the task should exit
-            else:
-                expected_next_state = state | set(['task_complete'])
-                if expected_next_state == next_state:
-                    return 1
-        elif action == 'Go to the battery charging station':
-            if 'The car battery is not full' in state and 'The passenger is at the drop-off location' in state:
-                expected_next_state = (state - set(['The car battery is not full']))| set(['The car battery is full'])
-                if expected_next_state == next_state:
-                    return 1
-            # If precondition are not met the task should exit
-            else:
-                expected_next_state = state | set(['task_complete'])
-                if expected_next_state == next_state:
-                    return 1
-
-        elif action == 'Exit the task':
-            expected_next_state = state | set(['task_complete'])
-            if next_state == expected_next_state:
-                return 1
-
-        return 0
-
-    def get_reward(self, state, action, participant_id=0):
-        if 'task_complete' in state:
-            return 0
-
-        total_reward = 0
-        for fact in self.all_reward_matrices[participant_id][action]:
-            if fact in state:
-                # if self.all_reward_matrices[participant_id][action][fact] > 0:
-                    # print("state: ", state, "action: ", action, "fact: ", fact, "reward: ", self.all_reward_matrices[participant_id][action][fact])
-                total_reward += self.all_reward_matrices[participant_id][action][fact]
-        return total_reward
-
     def read_rewards_excel_all_lines(self):
-        # read by default 1st sheet of an excel file
-        df = pd.read_excel(self.rewards_matrix_file)
-        #print(df)
-        #print(df.shape)
-        self.all_reward_matrices = []
-        self.number_of_participants = df.shape[0]
-        for row_id in range(1,df.shape[0]):
-            #print(df.iloc[row_id, 212:240])
-            # for col_id in range(212, 240):
-            #     print("row_id: ", row_id, "column_id: ", col_id, "value: ", df.iloc[row_id, col_id])
-            # all_rewards = df.iloc[row_id, 328:352].tolist()
-            all_rewards = df.iloc[row_id, 316:340].tolist()
-            # print(len(all_rewards))
-            # print(all_rewards)
-            action_list = self.get_actions()
-            fact_list = self.fact_list
-            rewards_matrix = {act: {fact: 0 for fact in fact_list} for act in action_list}
-            idx = 0
-            for fact in fact_list:
-                for act in action_list:
-                    if fact != 'task_complete':
-                        rewards_matrix[act][fact] = int(all_rewards[idx])
-                        idx = idx + 1
-            self.all_reward_matrices.append(rewards_matrix)
+        # the reward columns of every response as one numeric array; the workbook is parsed
+        # once for all domains and cached on disk, see survey.py
+        all_rewards = get_domain_rewards(self.rewards_matrix_file, 'SelfDriving')
+        if np.isnan(all_rewards).any():
+            raise ValueError("Non-numeric reward entries in " + self.rewards_matrix_file)
+        # rows of the sheet, including the row with the question texts
+        self.number_of_participants = all_rewards.shape[0] + 1
+        # dense (participants x actions x facts) weights, see MDP.set_reward_weights
+        self.set_reward_weights(all_rewards.astype(int))
 
 
 if __name__ == '__main__':
@@ -118,11 +66,14 @@ if __name__ == '__main__':
     mdp = SelfDriving('5.0 Prolific - Goals vs Rewards - Specify Objective_February 9, 2025_19.10.xlsx')
     # target_trajectory = []
     target_trajectory = ['Pick up the passenger from the initial position', 'Drop off the passenger at the drop-off location', 'Go to the battery charging station', 'Exit the task']
+    # every participant shares the transition model, so the whole cohort is solved in one batch;
+    # the reachable graph is acyclic, so a single backward-induction pass is exact, and
+    # participants who entered the same reward matrix are only solved once
+    cached_batch_solve(mdp, mdp.get_reward_tensor(), solver='backward_induction')
     for participant_id in range(len(mdp.all_reward_matrices)):
-        value_iteration(mdp, participant_id=participant_id)
         print("Participant ID: ", participant_id)
         correct_flag, underspecified_flag = test_specification(mdp, target_trajectory, participant_id=participant_id)
-        policy = get_policy(mdp)
+        policy = get_policy(mdp, participant_id=participant_id)
         policy_rollout = rollout_policy(mdp, policy, participant_id=participant_id)
         print("Policy Rollout: ", policy_rollout)
         if correct_flag:
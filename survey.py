@@ -0,0 +1,110 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+# spreadsheet columns [first, last) holding the reward table of every domain in the Qualtrics export
+REWARD_COLUMNS = {
+    'Navigation': (83, 107),
+    'SelfDriving': (316, 340),
+    'BlockStacking': (200, 228),
+}
+
+CACHE_DIR_NAME = '.survey_cache'
+
+# workbooks already loaded by this process, keyed by file content hash
+_loaded_surveys = {}
+
+
+def get_file_hash(file_title):
+    # sha256 of the workbook contents, so a re-exported survey never hits a stale cache entry
+    sha = hashlib.sha256()
+    with open(file_title, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_survey_rewards(file_title, cache_dir=None):
+    # Reward columns of every domain in REWARD_COLUMNS as float arrays of shape
+    # (participants x columns), one row per survey response. The workbook is parsed once,
+    # reading only those columns, and the result is cached on disk as <content hash>.npz
+    # (by default in .survey_cache next to the workbook), so later runs skip Excel entirely.
+    # Non-numeric cells come back as NaN; columns past the end of the sheet are left out.
+    file_hash = get_file_hash(file_title)
+    if file_hash in _loaded_surveys:
+        return _loaded_surveys[file_hash]
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_title)), CACHE_DIR_NAME)
+    cache_file = os.path.join(cache_dir, file_hash + '.npz')
+
+    rewards = _read_cache(cache_file)
+    if rewards is None:
+        rewards = _read_reward_columns(file_title)
+        _write_cache(cache_file, rewards)
+    _loaded_surveys[file_hash] = rewards
+    return rewards
+
+
+def get_domain_rewards(file_title, domain_name, cache_dir=None):
+    rewards = load_survey_rewards(file_title, cache_dir)
+    if domain_name not in rewards:
+        raise ValueError(file_title + " has no reward columns for " + domain_name)
+    return rewards[domain_name]
+
+
+def get_reward_columns(file_title, domain_name, n_columns):
+    # [first, last) of domain_name in a sheet whose header row is n_columns wide, with the same
+    # error as get_domain_rewards when the sheet ends before them
+    first, last = REWARD_COLUMNS[domain_name]
+    if last > n_columns:
+        raise ValueError(file_title + " has no reward columns for " + domain_name)
+    return first, last
+
+
+def clear_loaded_surveys():
+    # forgets the in-process copies, the next load goes back to the disk cache
+    _loaded_surveys.clear()
+
+
+def _read_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as cached:
+        # entries are only valid for the column ranges they were read with
+        for domain_name, (first, last) in REWARD_COLUMNS.items():
+            if ('columns_' + domain_name) in cached.files and \
+                    tuple(cached['columns_' + domain_name]) != (first, last):
+                return None
+        return {domain_name: cached[domain_name] for domain_name in REWARD_COLUMNS
+                if domain_name in cached.files}
+
+
+def _write_cache(cache_file, rewards):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    arrays = dict(rewards)
+    for domain_name in rewards:
+        arrays['columns_' + domain_name] = np.array(REWARD_COLUMNS[domain_name])
+    # write to a temporary file first so an interrupted run never leaves a truncated cache
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, cache_file)
+
+
+def _read_reward_columns(file_title):
+    # the header row alone tells how wide the sheet is
+    n_columns = pd.read_excel(file_title, nrows=0).shape[1]
+    ranges = {domain_name: (first, last) for domain_name, (first, last) in REWARD_COLUMNS.items()
+              if last <= n_columns}
+    usecols = sorted(set(col for first, last in ranges.values() for col in range(first, last)))
+    # read by default 1st sheet of an excel file
+    df = pd.read_excel(file_title, usecols=usecols)
+    position = {col: pos for pos, col in enumerate(usecols)}
+    rewards = {}
+    for domain_name, (first, last) in ranges.items():
+        # row 0 holds the question texts, the responses start at row 1
+        block = df.iloc[1:, [position[col] for col in range(first, last)]]
+        rewards[domain_name] = block.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    return rewards
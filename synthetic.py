@@ -0,0 +1,79 @@
+import numpy as np
+
+from MDP import MDP, ActionSchema
+
+
+class SyntheticDomain(MDP):
+    # Randomly generated domain for stress-testing the solvers at sizes the survey domains never
+    # reach. There are n_facts facts plus the absorbing task_complete, and n_actions actions plus
+    # 'Exit the task'. Every action has a few precondition facts and add / delete lists, drawn
+    # with the seed: if the preconditions hold it applies its effects, otherwise (and for
+    # 'Exit the task') the task completes, exactly like the survey domains. The initial state
+    # holds each fact with probability init_fraction (the more it holds, the more states are
+    # reachable: about 10^4 at 16 facts and 32 actions) and the cohort gets random integer
+    # survey rows, so instances work with value_iteration, the batch solvers,
+    # test_specification and rollout_policy. acyclic=False drops the guarantee that every
+    # transition makes progress, for testing the solvers on graphs with cycles.
+    def __init__(self, n_facts, n_actions, n_participants, discount=0.99, seed=0,
+                 max_preconditions=2, max_effects=2, acyclic=True, init_fraction=0.8, reward_range=(-5, 5)):
+        self.discount = discount
+        rng = np.random.default_rng(seed)
+        self.fact_list = ['fact ' + str(i) for i in range(n_facts)] + ['task_complete']
+        self.fact_set = set(self.fact_list)
+        self.action_schema = self.generate_action_schema(rng, n_facts, n_actions, max_preconditions, max_effects,
+                                                         acyclic)
+        self.actions = list(self.action_schema)
+        self.init_state = set(self.fact_list[i] for i in range(n_facts) if rng.random() < init_fraction)
+        self.state_space = self.generate_reachable_state_space()
+        self.compile_transition_model()
+        self.set_reward_weights(rng.integers(reward_range[0], reward_range[1] + 1,
+                                             size=(n_participants, n_facts * len(self.actions))))
+        self.init_solution_store(capacity=n_participants)
+
+    def generate_action_schema(self, rng, n_facts, n_actions, max_preconditions, max_effects, acyclic):
+        # {action: ActionSchema}, the add and delete lists of an action are disjoint.
+        # With acyclic every action consumes one of its preconditions and only touches facts
+        # listed before it, so each transition lowers the state bitmask and the graph is a DAG.
+        action_schema = {}
+        for a_idx in range(n_actions):
+            if acyclic:
+                consumed = int(rng.integers(0, n_facts))
+                facts = [self.fact_list[i] for i in rng.permutation(consumed)]
+            else:
+                facts = [self.fact_list[i] for i in rng.permutation(n_facts)]
+            n_preconditions = int(rng.integers(0, min(max_preconditions, len(facts)) + 1))
+            n_add = int(rng.integers(0, min(max_effects, len(facts)) + 1))
+            n_delete = int(rng.integers(0, min(max_effects, len(facts) - n_add) + 1))
+            preconditions = set(facts[:n_preconditions])
+            add_list = set(facts[:n_add])
+            delete_list = set(facts[n_add:n_add + n_delete])
+            if acyclic:
+                preconditions.add(self.fact_list[consumed])
+                delete_list.add(self.fact_list[consumed])
+            elif not add_list and not delete_list:
+                delete_list.add(facts[0])
+            action_schema['action ' + str(a_idx)] = ActionSchema(preconditions, add_list, delete_list)
+        action_schema['Exit the task'] = ActionSchema(add_list=['task_complete'])
+        return action_schema
+
+    def get_random_trajectory(self, length, seed=0):
+        # a random action sequence ending with 'Exit the task', e.g. as a target for test_specification
+        rng = np.random.default_rng(seed)
+        return [self.actions[i] for i in rng.integers(0, len(self.actions) - 1, size=length)] + ['Exit the task']
+
+
+if __name__ == '__main__':
+    import time
+    from Utils import batch_backward_induction, get_policy, test_specification, rollout_policy
+
+    for n_facts in [4, 8, 12, 16]:
+        start_time = time.time()
+        mdp = SyntheticDomain(n_facts, n_actions=2 * n_facts, n_participants=10)
+        built = time.time() - start_time
+        batch_backward_induction(mdp, mdp.get_reward_tensor())
+        print("Facts: ", n_facts, "States: ", len(mdp.get_state_space()), "Actions: ", len(mdp.get_actions()),
+              "Built in ", built, " seconds, solved in ", time.time() - start_time - built, " seconds")
+    target_trajectory = mdp.get_random_trajectory(3)
+    correct_flag, underspecified_flag = test_specification(mdp, target_trajectory, participant_id=0)
+    print("Policy Rollout: ", rollout_policy(mdp, get_policy(mdp, participant_id=0), participant_id=0))
+    print("Correct: ", correct_flag, "Underspecified: ", underspecified_flag)
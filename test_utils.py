@@ -0,0 +1,43 @@
+import numpy as np
+
+from synthetic import SyntheticDomain
+from Utils import SolveCache, SolverStats, cached_batch_solve
+
+
+def _duplicated_cohort(acyclic):
+    # 20 participants sharing 15 distinct reward tables
+    mdp = SyntheticDomain(6, 8, 15, acyclic=acyclic, seed=4)
+    rows = np.concatenate([np.arange(15), [0, 3, 3, 7, 14]])
+    return mdp, mdp.get_reward_tensor()[rows]
+
+
+def test_cached_batch_solve_reports_every_participant():
+    for acyclic, solver in ((True, 'backward_induction'), (False, 'value_iteration')):
+        mdp, rewards = _duplicated_cohort(acyclic)
+        stats = SolverStats()
+        cached_batch_solve(mdp, rewards, solver=solver, cache=SolveCache(), stats=stats)
+        record = stats.records[0]
+        assert len(np.unique(rewards.reshape(20, -1), axis=0)) == 15
+        assert len(record.participants) == 20
+        assert len(record.stopped_by) == len(record.participants)
+        assert 'cached' not in record.stopped_by
+        if solver == 'value_iteration':
+            assert len(record.participant_sweeps) == len(record.participants)
+            # duplicates of a row took as many sweeps as the row itself
+            assert record.participant_sweeps[15] == record.participant_sweeps[0]
+
+
+def test_cached_batch_solve_reports_cache_hits():
+    mdp, rewards = _duplicated_cohort(False)
+    cache = SolveCache()
+    cached_batch_solve(mdp, rewards[:10], solver='value_iteration', cache=cache)
+    stats = SolverStats()
+    cached_batch_solve(mdp, rewards, solver='value_iteration', cache=cache, stats=stats)
+    record = stats.records[0]
+    assert len(record.stopped_by) == len(record.participants) == 20
+    assert len(record.participant_sweeps) == 20
+    assert record.stopped_by[:10] == ['cached'] * 10
+    assert (record.participant_sweeps[:10] == 0).all()
+    assert record.stopped_by[10:15] == ['residual'] * 5
+    # rows 15-19 repeat rows 0, 3, 3, 7 and 14
+    assert record.stopped_by[15:] == ['cached'] * 4 + ['residual']